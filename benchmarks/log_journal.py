@@ -0,0 +1,64 @@
+'''
+Measures what a TSVLogger.write() costs the caller with plain and
+journaled files, synchronous and threaded, and what group commit saves
+over fsync'ing every row.
+
+Rows are written at a steady rate, like events during a run, and the
+script reports the median, 99.9th percentile and maximum time spent in
+write(), plus the total time to close (which includes the final commit
+and, for journals, rebuilding the TSV).
+
+Usage (from the repository root)::
+
+    python -m benchmarks.log_journal --rows 2000 --rate 200
+'''
+from argparse import ArgumentParser
+from time import perf_counter as time
+from time import sleep
+import tempfile
+
+import numpy as np
+
+from util.logging import TSVLogger
+
+FIELDS = ['event', 'trial', 'timestamp']
+
+CONFIGS = dict(
+    plain = dict(),
+    plain_threaded = dict(threaded = True),
+    journal = dict(journal = True),
+    journal_threaded = dict(journal = True, threaded = True),
+    journal_fsync_every_row = dict(journal = True, fsync_interval = 0.),
+)
+
+def run(config, n_rows, rate, dir):
+    log = TSVLogger('bench', config, 'events', FIELDS, dir = dir,
+                    **CONFIGS[config])
+    lat = np.empty(n_rows)
+    for i in range(n_rows):
+        t0 = time()
+        log.write(event = 'stimulation', trial = i)
+        lat[i] = time() - t0
+        sleep(1 / rate)
+    t0 = time()
+    log.close()
+    return lat, time() - t0
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type = int, default = 2000)
+    parser.add_argument('--rate', type = float, default = 200.,
+        help = 'rows written per second')
+    parser.add_argument('--dir', help = 'where to write (default: a temp dir)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for config in CONFIGS:
+            lat, close = run(config, args.rows, args.rate, args.dir or tmp)
+            lat = 1e6 * lat
+            print('%-24s write: median %6.1f us, p99.9 %8.1f us, max %8.1f us;'
+                    ' close %6.1f ms'%(
+                    config, np.median(lat), np.percentile(lat, 99.9), lat.max(),
+                    1e3 * close
+                    ))
@@ -0,0 +1,87 @@
+'''
+Compares the latency and accuracy of LogisticOptimalDesign's inference
+backends on a simulated observer.
+
+Every backend sees the same sequence of (latency, response) pairs, chosen
+by Thompson sampling from a fine 'grid' posterior, which also serves as the
+exact reference that the approximate backends are scored against.
+
+Usage (from the repository root)::
+
+    python -m benchmarks.oed_backends --trials 100 --backends svi laplace smc
+'''
+from argparse import ArgumentParser
+from time import perf_counter as time
+import warnings
+
+import numpy as np
+from scipy.special import expit
+
+from util.oed.logistic import LogisticOptimalDesign
+
+PRIORS = dict(
+    alpha_mean = 300,
+    alpha_scale = 50,
+    beta_mean = 0.017,
+    beta_scale = 0.005,
+)
+CANDIDATES = np.arange(0, 1000)
+
+def run(backends, n_trials, true_alpha, true_beta, seed):
+    np.random.seed(seed)
+    ref = LogisticOptimalDesign(
+        candidate_designs = CANDIDATES, backend = 'grid',
+        n_alpha = 600, n_beta = 200, seed = seed, **PRIORS
+        )
+    designs = {
+        b: LogisticOptimalDesign(
+            candidate_designs = CANDIDATES, backend = b, seed = seed, **PRIORS
+            )
+        for b in backends
+    }
+    latency = {b: [] for b in backends}
+    error = {b: [] for b in backends}
+    for trial in range(n_trials):
+        x = ref.get_next_x('bopt')
+        y = int(np.random.random() < expit(true_beta * (x - true_alpha)))
+        ref.update_model(x, y)
+        target = ref.get_param_estimates()
+        for b, des in designs.items():
+            t0 = time()
+            des.update_model(x, y)
+            latency[b].append(time() - t0)
+            est = des.get_param_estimates()
+            error[b].append([
+                est['alpha_mean'] - target['alpha_mean'],
+                est['alpha_scale'] - target['alpha_scale'],
+                est['beta_mean'] - target['beta_mean'],
+            ])
+    return latency, error, ref.get_param_estimates()
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--backends', nargs = '+', default = ['svi', 'laplace', 'smc'])
+    parser.add_argument('--trials', type = int, default = 100)
+    parser.add_argument('--alpha', type = float, default = 250.)
+    parser.add_argument('--beta', type = float, default = 0.025)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore') # pyro's JIT warnings
+    latency, error, ref = run(
+        args.backends, args.trials, args.alpha, args.beta, args.seed
+        )
+    print('\nexact posterior after %d trials: alpha = %.1f +/- %.1f ms'%(
+        args.trials, ref['alpha_mean'], ref['alpha_scale']
+        ))
+    print('\n%-10s %12s %12s %14s %14s %12s'%(
+        'backend', 'median (ms)', 'max (ms)',
+        'alpha mean err', 'alpha sd err', 'beta err'
+        ))
+    for b in args.backends:
+        lat = 1e3 * np.array(latency[b])
+        err = np.abs(np.array(error[b])).mean(0)
+        print('%-10s %12.2f %12.2f %14.2f %14.2f %12.5f'%(
+            b, np.median(lat), lat.max(), err[0], err[1], err[2]
+            ))
@@ -0,0 +1,100 @@
+'''
+Measures how much model fitting disturbs the experiment's timing when it
+runs on a thread in the experiment process versus in a DesignServer
+worker process.
+
+A stand-in for the PsychoPy loop waits for 60 Hz frame deadlines (like
+win.flip) and, on every few frames, for a stimulation deadline polled the
+way Keyboard.waitKeys(maxWait = ...) does, recording how late each one is
+while update_model runs back to back in the background.
+
+Usage (from the repository root)::
+
+    python -m benchmarks.oed_server_jitter --backend svi --seconds 20
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter as time
+from time import sleep
+import threading
+import warnings
+
+import numpy as np
+
+from util.oed.logistic import LogisticOptimalDesign
+from util.oed.server import DesignServer
+
+DESIGN = dict(
+    alpha_mean = 300,
+    alpha_scale = 50,
+    beta_mean = 0.017,
+    beta_scale = 0.005,
+    candidate_designs = np.arange(0, 1000),
+)
+FRAME = 1 / 60.
+
+def timing_loop(seconds, stim_latency = .3):
+    '''
+    returns lateness (s) of frame deadlines and of stimulation deadlines
+    '''
+    frames, stims = [], []
+    t_end = time() + seconds
+    deadline = time() + FRAME
+    while time() < t_end:
+        sleep(max(0., deadline - time()))
+        frames.append(time() - deadline)
+        deadline += FRAME
+        if len(frames) % 30 == 0: # a "trial": poll until stimulation is due
+            t_stim = time() + stim_latency
+            while time() < t_stim:
+                sleep(.0005)
+            stims.append(time() - t_stim)
+            deadline = time() + FRAME
+    return np.array(frames), np.array(stims)
+
+def fit_forever(update, stop):
+    x = 300.
+    while not stop.is_set():
+        y = int(np.random.random() < .5)
+        update(x, y)
+        x = np.random.uniform(200, 400)
+
+def measure(mode, backend, seconds):
+    stop = threading.Event()
+    design = dict(DESIGN, backend = backend)
+    if mode == 'thread':
+        des = LogisticOptimalDesign(**design)
+        update = des.update_model
+    elif mode == 'process':
+        des = DesignServer(**design).start()
+        des.estimates() # wait until worker is up
+        update = des.update
+    if mode != 'idle':
+        executor = ThreadPoolExecutor(max_workers = 1)
+        executor.submit(fit_forever, update, stop)
+    frames, stims = timing_loop(seconds)
+    stop.set()
+    if mode != 'idle':
+        executor.shutdown()
+    if mode == 'process':
+        des.close()
+    return frames, stims
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--backend', default = 'svi')
+    parser.add_argument('--seconds', type = float, default = 20.)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    print('\n%-8s %14s %14s %14s %14s'%(
+        'fitting', 'frame sd (ms)', 'frame max (ms)',
+        'stim mean (ms)', 'stim max (ms)'
+        ))
+    for mode in ('idle', 'thread', 'process'):
+        frames, stims = measure(mode, args.backend, args.seconds)
+        print('%-8s %14.3f %14.3f %14.3f %14.3f'%(
+            mode, 1e3 * frames.std(), 1e3 * frames.max(),
+            1e3 * stims.mean(), 1e3 * stims.max()
+            ))
@@ -0,0 +1,112 @@
+'''
+Measures end-to-end TR timing with an emulated scanner: how long after
+each trigger is sent the TR listener logs it, and how long until a
+process blocked in TRSync.wait_for_TR wakes for it (the latency of
+starting a block or trial on a TR), optionally with other processes
+loading the CPU. Also checks that triggers the emulator dropped are
+flagged as missed.
+
+Triggers go through a pipe by default, or with --uinput through a
+virtual keyboard and psychtoolbox (Linux, needs python-evdev and
+psychopy), as a button box's would. Through the pipe, each trigger is
+logged with the time the emulator stamped it with, so only the latencies
+are measured; with --uinput, psychtoolbox stamps the key press itself,
+and the benchmark also reports how far that stamp is from when the
+trigger was sent (both on CLOCK_MONOTONIC on Linux).
+
+Usage (from the repository root)::
+
+    python -m benchmarks.tr_latency --TR .1 --n-TRs 300 --dropout .02 --load 2
+'''
+from argparse import ArgumentParser
+from multiprocessing import Process
+from time import perf_counter as time
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from util.mri import TRSync
+from util.scanner import ScannerEmulator, UINPUT_NAME
+
+KEY = 's'
+
+def spin():
+    while True:
+        pass
+
+def summary(name, x):
+    x = 1e3 * np.asarray(x)
+    print('%-26s median %7.3f ms, p99 %7.3f ms, max %7.3f ms'%(
+        name, np.median(x), np.percentile(x, 99), x.max()
+        ))
+
+def run(args, log_dir):
+    emulator = ScannerEmulator(
+        args.TR, args.jitter, args.dropout, args.n_TRs, start_delay = 1.,
+        seed = args.seed, uinput_key = KEY if args.uinput else None
+        )
+    listener = TRSync(
+        'bench', '01', UINPUT_NAME, KEY, args.poll_rate,
+        key_source = emulator.key_source, log_dir = log_dir
+        )
+    load = [Process(target = spin, daemon = True) for i in range(args.load)]
+    for p in load:
+        p.start()
+    emulator.start(begin = False) # so a uinput keyboard exists to listen on
+    listener.start()
+    emulator.begin()
+    woke = []
+    while True: # until the emulator's done and no more TRs come
+        t = listener.wait_for_TR(len(woke) + 1, timeout = 1. + 3 * args.TR)
+        if t is None:
+            break
+        woke.append(time())
+    times = emulator.join()
+    stats = listener.stop()
+    for p in load:
+        p.terminate()
+    log = pd.read_csv(os.path.join(
+        log_dir, 'sub-bench', 'sub-bench_run-01_log-TR.tsv'
+        ), sep = '\t')
+    return times, stats, log, np.array(woke)
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--TR', type = float, default = .1)
+    parser.add_argument('--n-TRs', type = int, default = 300)
+    parser.add_argument('--jitter', type = float, default = 0.,
+        help = 'sd of trigger times, in seconds')
+    parser.add_argument('--dropout', type = float, default = .02)
+    parser.add_argument('--load', type = int, default = 0,
+        help = 'number of processes spinning on the CPU meanwhile')
+    parser.add_argument('--poll-rate', type = float, default = 500.)
+    parser.add_argument('--uinput', action = 'store_true')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        times, stats, log, woke = run(args, tmp)
+    if stats is None or stats['error'] is not None:
+        raise SystemExit('TR listener failed: %s'%(
+            stats['error'] if stats is not None else 'no summary'
+            ))
+    sent = times['sent']
+    n = min(sent.size, len(log), woke.size) # pulses arrive in order
+    print('%d triggers sent, %d dropped; %d logged, %d flagged missed, '
+            '%d extra, %d late, %d early'%(
+            sent.size, times['dropped'].size, len(log),
+            stats['n_TR_missed'], stats['n_TR_extra'],
+            stats['n_TR_late'], stats['n_TR_early']
+            ))
+    print('TR estimate %.6f s (jitter %.3f ms); listener used %.1f%% CPU'%(
+        stats['TR_estimate'], 1e3 * stats['TR_jitter_estimate'],
+        100 * stats['cpu_fraction']
+        ))
+    if args.uinput: # pipe triggers carry the send time, so no error
+        summary('timestamp error',
+                np.abs(log.timestamp.values[:n] - sent[:n]))
+    summary('trigger to log', log.detected.values[:n] - sent[:n])
+    summary('trigger to wait_for_TR', woke[:n] - sent[:n])
@@ -0,0 +1,164 @@
+'''
+Fits a population-level prior over each subject's agency threshold offset
+(alpha minus their mean baseline RT) and slope beta from the behavioral
+logs of past subjects, and saves it for experiment.get_priors to use in
+place of the hard-coded run-02 priors.
+
+Usage::
+
+    python build_priors.py --logs logs --out logs/priors.json
+
+Each subject's logs are read in a separate process. A subject contributes
+the final posterior of their last stimulation run (from its checkpoint, if
+there is one), relative to the mean RT of their run-01 baseline block;
+subjects without both are skipped.
+
+The prior is the predictive distribution for a new subject: the spread
+between subjects, which is floored so few subjects can't make it vanish,
+plus the uncertainty in the population mean.
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+
+from util.oed.logistic import LogisticOptimalDesign, inverse_reparam, \
+                                read_checkpoint
+
+# smallest prior scales worth saving; anything narrower means the fit failed
+MIN_SCALE = dict(alpha_offset_scale = 1., beta_scale = 1e-4)
+
+def final_posterior(sub_dir, run, df):
+    '''
+    The posterior estimates at the end of a stimulation run: from its
+    checkpoint if there is one, or else from the estimates logged with
+    its last trial (which were made before that trial) updated with that
+    trial's response.
+    '''
+    sub = os.path.basename(sub_dir)[len('sub-'):]
+    ckpt_f = os.path.join(sub_dir, 'sub-%s_run-%s_oed.ckpt'%(sub, run))
+    if os.path.exists(ckpt_f):
+        return read_checkpoint(ckpt_f)['estimates']
+    last = df.iloc[-1]
+    des = LogisticOptimalDesign(
+        last.alpha_mean, last.alpha_scale, last.beta_mean, last.beta_scale,
+        candidate_designs = np.arange(0, 1000), backend = 'laplace'
+        )
+    y = 1 if str(last.pressed_first) == 'True' else int(last.agency)
+    des.update_model(last.latency, y)
+    return des.get_param_estimates()
+
+def summarize_subject(sub_dir):
+    '''
+    Returns one subject's baseline RT and final posterior estimates as a
+    dict, or None if they don't have both a baseline and a stimulation run.
+    '''
+    runs = dict()
+    for f in glob(os.path.join(sub_dir, 'sub-*_run-*_log-beh.tsv')):
+        run = re.search(r'_run-(\d+)_', os.path.basename(f)).group(1)
+        runs[run] = pd.read_csv(f, sep = '\t')
+    if '01' not in runs:
+        return None
+    rts = runs['01'].rt.dropna()
+    stim = [
+        (run, df[df.trial_type == 'stimulation'].dropna(subset = ['alpha_mean']))
+        for run, df in sorted(runs.items()) if run != '01'
+    ]
+    stim = [(run, df) for run, df in stim if len(df)]
+    if rts.empty or not stim:
+        return None
+    post = final_posterior(sub_dir, *stim[-1])
+    return dict(
+        sub = os.path.basename(sub_dir),
+        rt_mean = rts.mean(),
+        alpha_offset = float(post['alpha_mean']) - rts.mean(),
+        alpha_scale = float(post['alpha_scale']),
+        beta_mu = float(post['beta_mu']),
+        beta_sigma = float(post['beta_sigma']),
+        n_trials = sum(len(df) for _, df in stim),
+    )
+
+def random_effects(est, se, min_tau = .25):
+    '''
+    Empirical Bayes fit of est[i] ~ N(mu, tau^2 + se[i]^2), i.e. the
+    population mean and spread of a quantity each subject's estimate of
+    which has its own posterior standard deviation se[i].
+
+    tau is estimated by REML, which unlike maximum likelihood accounts
+    for mu being estimated from the same data, but still often finds no
+    spread at all when it's smaller than the se's (as it usually is, with
+    few subjects), so it's floored at min_tau times the median se.
+
+    Returns mu and the predictive standard deviation for a new subject:
+    sqrt(tau^2 + se(mu)^2).
+    '''
+    est, se = np.asarray(est, float), np.asarray(se, float)
+    def fit_mu(tau):
+        w = 1 / (tau**2 + se**2)
+        return np.sum(w * est) / np.sum(w), w
+    def nll(log_tau): # restricted (REML) negative log likelihood
+        mu, w = fit_mu(np.exp(log_tau[0]))
+        return 0.5 * (np.sum(-np.log(w) + w * (est - mu)**2) + np.log(np.sum(w)))
+    x0 = [np.log(est.std() + np.median(se))]
+    tau = np.exp(minimize(nll, x0, method = 'Nelder-Mead').x[0])
+    tau = max(tau, min_tau * np.median(se))
+    mu, w = fit_mu(tau)
+    return mu, np.sqrt(tau**2 + 1 / np.sum(w))
+
+def build_priors(log_dir = 'logs', workers = None):
+    '''
+    Scans every subject's logs in parallel and returns the population prior
+    (as a dict) along with the per-subject summaries it was fit to.
+    '''
+    sub_dirs = sorted(glob(os.path.join(log_dir, 'sub-*')))
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        subs = [s for s in executor.map(summarize_subject, sub_dirs) if s]
+    subs = pd.DataFrame(subs)
+    if subs.empty:
+        raise ValueError('no subjects with usable logs in %s'%log_dir)
+    offset, offset_sd = random_effects(subs.alpha_offset, subs.alpha_scale)
+    beta_mu, beta_sigma = random_effects(subs.beta_mu, subs.beta_sigma)
+    beta_mean, beta_scale = inverse_reparam(beta_mu, beta_sigma)
+    priors = dict(
+        alpha_offset = float(offset),
+        alpha_offset_scale = float(offset_sd),
+        beta_mean = float(beta_mean),
+        beta_scale = float(beta_scale),
+        n_subjects = len(subs),
+        subjects = list(subs['sub']),
+    )
+    return priors, subs
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--logs', default = 'logs')
+    parser.add_argument('--out', default = os.path.join('logs', 'priors.json'))
+    parser.add_argument('--min-subjects', type = int, default = 5,
+        help = "don't save a prior fit to fewer subjects than this")
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    args = parser.parse_args()
+
+    priors, subs = build_priors(args.logs, args.workers)
+    print(subs.to_string(index = False, float_format = '%.4g'))
+    print('\nalpha offset %.1f ms (sd %.1f), beta %.4f (sd %.4f), '
+            'from %d subjects'%(
+            priors['alpha_offset'], priors['alpha_offset_scale'],
+            priors['beta_mean'], priors['beta_scale'], priors['n_subjects']
+            ))
+    if priors['n_subjects'] < args.min_subjects:
+        raise SystemExit('Too few subjects to save priors (see --min-subjects).')
+    for key, low in MIN_SCALE.items():
+        if not priors[key] >= low: # also catches NaN
+            raise SystemExit('Not saving priors: %s of %g is degenerate.'%(
+                key, priors[key]
+                ))
+    with open(args.out, 'w') as f:
+        json.dump(priors, f, indent = 2)
+    print('Saved to %s'%args.out)
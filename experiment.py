@@ -1,16 +1,20 @@
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from warnings import warn
 from sys import stdout
 import numpy as np
 import pandas as pd
+import json
 import os
 
-from util.oed.logistic import LogisticOptimalDesign
+from util.oed.logistic import LogisticOptimalDesign, read_checkpoint
+from util.oed.joint import JointOptimalDesign
+from util.oed.server import DesignServer
 from util.ui import EventHandler
 from util.logging import TSVLogger
 from util.ems import EMS
 from util.mri import TRSync
+from util.scanner import ScannerEmulator, UINPUT_NAME
 from psychopy import event, core
 
 from time import perf_counter as time
@@ -26,13 +30,48 @@ RT_KEY = '9'
 STIM_INTERVAL_START = 0 # in milliseconds relative to RT trial start
 STIM_INTERVAL_END = 1000
 
+# how LogisticOptimalDesign approximates the posterior ('svi', 'grid', 'laplace' or 'smc')
+OED_BACKEND = 'svi'
+OED_OPTIONS = dict(incremental = True) # extra arguments for the backend
+# NOTE: a resumed 'svi' run only picks up exactly where it left off if no
+# refit was cut short by its time_budget (1 second by default), since where
+# that stops depends on the machine's speed; the other backends always do
+OED_IN_WORKER = True # fit model in a separate process (see DesignServer)
+# choose stimulation intensity along with latency (see JointOptimalDesign:
+# each trial uses the intensity where the likely thresholds are most
+# informative), from this many intensities up to and including the one
+# entered at startup
+JOINT_DESIGN = False
+N_INTENSITIES = 20
+# seed for the design's random draws; None picks a new one each run (it is
+# saved with the design settings, so replay.py can reproduce the run)
+OED_SEED = None
+
+# population prior from past subjects, made by build_priors.py (if it exists,
+# it replaces the hard-coded priors for run 02)
+PRIOR_FILE = os.path.join('logs', 'priors.json')
+
 # trial counts (per block)
 BLOCK_DURATION = 60*10
 
 MRI_EMULATED_KEY = 's' # key to be 'pressed' on keyboard every TR
+TR_POLL_RATE = 500 # times per second the TR listener checks for triggers
+TR_SECONDS = None # expected TR; if None, it's estimated from the first TRs
+# to run without a scanner, set to 'pipe' (triggers go straight to the TR
+# listener) or 'uinput' (they're pressed on a virtual keyboard; Linux only)
+SCANNER_EMULATOR = None
+EMULATED_TR = 2.
+EMULATED_TR_JITTER = 0. # sd, in seconds
+EMULATED_TR_DROPOUT = 0. # probability of each trigger being dropped
+# start each trial's Go! cue on a TR, by holding the fixation cross past its
+# 2-4 second jitter until the next TR arrives
+LOCK_TRIALS_TO_TR = False
+# but if no TR comes within this many TRs (taking a TR as 3 seconds while
+# it's unknown), start the trial anyway, so a stalled scanner can't hang it
+TR_LOCK_TIMEOUT = 3
 
 ## BLOCK DEFINITIONS #################################################################
-def baseline_block(ui, log, run, tr_listener):
+def baseline_block(ui, log, run, tr_listener, scanner = None):
 
 	t0 = time()
 	print('\nBeginning baseline test.')
@@ -69,7 +108,7 @@ def baseline_block(ui, log, run, tr_listener):
 	'''
 	)
 	print('\n\nWaiting for MRI!')
-	tr_listener.wait_until_first_TR()
+	wait_for_scanner(tr_listener, scanner)
 
 	clock = core.Clock()
 	clock.reset()
@@ -83,7 +122,7 @@ def baseline_block(ui, log, run, tr_listener):
 		ui.waitPress()
 
 		# variable fixation (2-4 seconds) and then start trial
-		ui.fixation_cross(2 + 2*np.random.random())
+		fixate(ui, tr_listener)
 		rt, _ = ui.rt_trial() # cues movement and collects response time
 
 		# record trial data to log file
@@ -97,19 +136,62 @@ def baseline_block(ui, log, run, tr_listener):
 	return
 
 
-def stimulation_block(ui, log, run, tr_listener, priors):
+def stimulation_block(ui, log, run, tr_listener, priors, checkpoint,
+						resume = False, events_log = None, scanner = None):
+
+	global intensity # on_stimulate applies whatever this is set to
 
 	## initialize optimal experiment design object
-	des = LogisticOptimalDesign(
+	if OED_SEED is None:
+		seed = int(np.random.SeedSequence().generate_state(1)[0])
+	else:
+		seed = OED_SEED
+	design_kwargs = dict(
 		candidate_designs = np.arange(STIM_INTERVAL_START, STIM_INTERVAL_END),
+		checkpoint = checkpoint, # saved after every trial
+		seed = seed,
 		**priors
 	)
-	executor = ThreadPoolExecutor(max_workers = 1) # for asyncronous model fitting
+	if JOINT_DESIGN: # never stimulate above the intensity entered at startup
+		design = JointOptimalDesign
+		design_kwargs['candidate_intensities'] = np.arange(
+			max(1, intensity - N_INTENSITIES + 1), intensity + 1
+			)
+	else:
+		design = LogisticOptimalDesign
+		design_kwargs.update(backend = OED_BACKEND, **OED_OPTIONS)
+	if not resume: # so the block can be replayed later (see replay.py)
+		save_design_config(
+			os.path.splitext(checkpoint)[0] + '.json', design, design_kwargs
+			)
+	if OED_IN_WORKER and resume:
+		des = DesignServer(resume = checkpoint, design_class = design).start()
+	elif OED_IN_WORKER:
+		des = DesignServer(design_class = design, **design_kwargs).start()
+	elif resume: # pick up from the last trial before the crash
+		des = design.load_checkpoint(checkpoint)
+	else:
+		des = design(**design_kwargs)
+	# for asyncronous model fitting, one worker per speculative branch
+	executor = ThreadPoolExecutor(max_workers = 2)
+	# get one-off inference costs out of the way before the scanner starts
+	t_warmup = time()
+	warmed_up = executor.submit(des.warmup, 'bopt')
 
 	## now start stimulation trials
 	t0 = time()
 	print('Displaying instructions...')
-	if run == '02':
+	if resume:
+		ui.display(
+		'''
+		The block will now continue where it left off.
+		If you have any questions, please ask.
+		Otherwise, you may begin.
+		(press to start)
+		'''
+		)
+		ui.waitPress()
+	elif run == '02':
 		ui.display(
 		'''
 		You have finished the first block. Please read the following
@@ -176,34 +258,51 @@ def stimulation_block(ui, log, run, tr_listener, priors):
 	'''
 	)
 	print('\n\nWaiting for MRI!')
-	tr_listener.wait_until_first_TR()
+	wait_for_scanner(tr_listener, scanner)
 	print('\nBeginning stimulation block.')
+	print('Inference warmup took %.2f seconds.'%warmed_up.result())
+	if events_log is not None:
+		events_log.write(
+			event = 'oed_warmup', timestamp = t_warmup,
+			duration = warmed_up.result()
+			)
 
 	clock = core.Clock()
 	clock.reset()
-	trial = 0
-	while clock.getTime() < BLOCK_DURATION:
+	des.start_clock()
+	progress = des.get_progress() # nothing done yet unless resuming
+	trial = progress['trials']
+	elapsed = progress['elapsed']
+	model_updated = None
+	while clock.getTime() + elapsed < BLOCK_DURATION:
 		
 		trial += 1
 		
 		ui.display('Press button to begin trial.')
 		ui.waitPress()
-		ui.fixation_cross(2 + 2*np.random.random())
-
-		if trial > 1: # wait until model has finished updating from last trial
-			wait([model_updated]) # though it should already be done by now
+		fixate(ui, tr_listener)
 
 		# select next stimulation latency via Bayesian optimization
+		if model_updated is not None: # wait until model has finished updating
+			next_x = model_updated.result() # though it should be done
+		else:
+			next_x = des.get_next_x('bopt')
+		if JOINT_DESIGN:
+			stim_latency, intensity = next_x[0], int(next_x[1])
+		else:
+			stim_latency = next_x
 		params = des.get_param_estimates()
-		stim_latency = des.get_next_x('bopt')
 		rt, pf = ui.rt_trial(stimulation = stim_latency)
 
+		# while subject reads the question, update the model and choose the
+		# next latency for both answers they might give
+		des.speculate(next_x, executor, 'bopt')
 		# solicit subject's agency judgment
 		resp = ui.get_response()
-		# and use it to start updating the logistic model
+		t_resp = time()
+		# and use it to pick which of those updates to keep
 		_resp = 1 if pf else resp # discount trials subjects actually caused press
-		model_updated = executor.submit(des.update_model, stim_latency, _resp)
-		log.write(
+		row = dict(
 			trial_type = 'stimulation',
 			trial = trial,
 			intensity = intensity,
@@ -211,22 +310,122 @@ def stimulation_block(ui, log, run, tr_listener, priors):
 			rt = rt,
 			pressed_first = pf,
 			agency = resp,
+			timestamp = time(),
 			**params
 			)
-
+		# the trial is logged once its model update is done, with diagnostics
+		first_update = model_updated is None # in this block, even if resumed
+		model_updated = executor.submit(commit_and_log, des, log, _resp, row)
+		if first_update: # should be no slower than later ones after warmup
+			model_updated.add_done_callback(
+				lambda f, t = t_resp: log_first_update(events_log, t)
+				)
+
+	if model_updated is not None:
+		model_updated.result() # so last trial is logged
+	if OED_IN_WORKER:
+		des.close()
 	print('\nEnding stimulation block at %d minutes.'%((time() - t0)/60))
 	return
 
+def wait_for_scanner(tr_listener, scanner = None):
+	'''
+	Waits for the run's first TR, after starting the scanner emulator's
+	triggers (if emulating), as the operator would start a real scan.
+	'''
+	if scanner is not None:
+		scanner.begin()
+	tr_listener.wait_until_first_TR()
+
+def fixate(ui, tr_listener):
+	'''
+	Shows the fixation cross for 2-4 seconds, then (if LOCK_TRIALS_TO_TR)
+	until the next TR, so the trial that follows starts on the scanner's
+	clock. Returns the TR the trial is locked to, or None (also if the TR
+	doesn't come within TR_LOCK_TIMEOUT TRs, after which the trial goes on
+	with just the jittered fixation).
+	'''
+	ui.fixation_cross(2 + 2*np.random.random())
+	if not LOCK_TRIALS_TO_TR:
+		return None
+	period = TR_SECONDS or tr_listener.TR_period() or 3.
+	n = tr_listener.n_TRs + 1
+	if tr_listener.wait_for_TR(n, timeout = TR_LOCK_TIMEOUT * period) is None:
+		warn('No TR for %.1f seconds; starting the trial without one.'%(
+			TR_LOCK_TIMEOUT * period
+			))
+		return None
+	return n
+
+def log_first_update(events_log, t_resp):
+	'''
+	reports how long after the block's first response (the first since
+	resuming, if it was) its model update was ready
+	'''
+	latency = time() - t_resp
+	print('First model update ready %.3f seconds after response.'%latency)
+	if events_log is not None:
+		events_log.write(
+			event = 'first_update', timestamp = t_resp, duration = latency
+			)
+
+def commit_and_log(des, log, resp, row):
+	'''
+	adopts the model update for the subject's response, then logs the trial
+	along with that update's diagnostics; returns the next latency
+	'''
+	next_x = des.commit(resp)
+	log.write(**row, **des.get_diagnostics())
+	return next_x
+
+def save_design_config(fpath, design, design_kwargs):
+	'''
+	saves the design object's class and arguments as JSON
+	'''
+	config = dict(design = design.__name__, **design_kwargs)
+	with open(fpath, 'w') as f:
+		json.dump(config, f, default = lambda v: np.asarray(v).tolist())
+
+def get_checkpoint_path(sub, run, dir):
+	'''
+	where a run's design object is saved after each trial
+	'''
+	return os.path.join(dir, 'sub-%s_run-%s_oed.ckpt'%(sub, run))
+
 def get_priors(sub, run, dir):
 	'''
 	constructs priors for Bayesian Optimization
 	'''
 	prev_run = '%02d'%(int(run) - 1)
+	prev_ckpt_f = get_checkpoint_path(sub, prev_run, dir)
+	if run != '02' and os.path.exists(prev_ckpt_f):
+		# posterior from last time, without re-reading its log, and
+		# with its prior's uncertainty
+		ckpt = read_checkpoint(prev_ckpt_f)
+		return dict(
+			alpha_mean = ckpt['estimates']['alpha_mean'],
+			alpha_scale = ckpt['init']['alpha_scale'],
+			beta_mean = ckpt['init']['beta_mean'],
+			beta_scale = ckpt['init']['beta_scale']
+		)
 	prev_run_f = os.path.join( # path to previous log file
 		dir, 'sub-%s_run-%s_log-%s.tsv'%(sub, prev_run, 'beh')
 		)
 	df = pd.read_csv(prev_run_f, sep = '\t')
-	if run == '02':
+	if run == '02' and os.path.exists(PRIOR_FILE):
+		with open(PRIOR_FILE) as f:
+			pop = json.load(f)
+		pretest_rts = df.rt.dropna()
+		priors = dict(
+			alpha_mean = np.mean(pretest_rts) + pop['alpha_offset'],
+			# spread across subjects, plus uncertainty in this one's mean RT
+			alpha_scale = np.sqrt(
+				pop['alpha_offset_scale']**2 + np.var(pretest_rts)/len(pretest_rts)
+				),
+			beta_mean = pop['beta_mean'],
+			beta_scale = pop['beta_scale'],
+		)
+	elif run == '02':
 		pretest_rts = df.rt
 		priors = dict(
 			alpha_mean = np.mean(pretest_rts) - 40, # RT minus preemptive gain
@@ -261,10 +460,22 @@ if __name__ == '__main__':
 	intensity = input("Enter stimulation intensity: ")
 	intensity = int(intensity)
 
-	## set up log files
-	ev_log = TSVLogger(sub, run, 'events', ['event', 'timestamp'])
+	## resume a stimulation block that crashed part way through?
+	ckpt_f = get_checkpoint_path(sub, run, os.path.join('logs', 'sub-%s'%sub))
+	resume = False
+	if os.path.exists(ckpt_f):
+		resume = input("Found a checkpoint for this run. Resume it? (y/n) ")
+		resume = resume.strip().lower() == 'y'
+
+	## set up log files (written from background threads, so that logging
+	## a stimulation doesn't delay the response it's waiting for, and
+	## journaled, so a crash loses at most a fraction of a second of them)
+	ev_log = TSVLogger( # duration is for the design's warmup and first update
+		sub, run, 'events', ['event', 'timestamp', 'duration'],
+		append = resume, threaded = True, journal = True
+		)
 	beh_log = TSVLogger(
-		sub, run, 'beh',
+		sub, run, 'beh', append = resume, threaded = True, journal = True,
 		fields = [
 			'trial_type', 'trial', 'intensity',
 			'latency', 'rt', 'pressed_first',
@@ -272,11 +483,30 @@ if __name__ == '__main__':
 			'alpha_mean', 'alpha_scale',
 			'alpha_mu', 'alpha_sigma',
 			'beta_mean', 'beta_scale',
-			'beta_mu', 'beta_sigma'
+			'beta_mu', 'beta_sigma',
+			'gamma_mean', 'gamma_scale',
+			'fit_iters', 'fit_elbo', 'fit_elbo_trend', 'fit_seconds',
+			'fit_converged', 'd_alpha_mu', 'd_alpha_sigma',
+			'd_beta_mu', 'd_beta_sigma'
 			]
 		)
 
-	tr_listener = TRSync(sub, run, KB_NAME, MRI_EMULATED_KEY)
+	scanner = None
+	if SCANNER_EMULATOR is not None:
+		warn('Emulating the scanner!')
+		scanner = ScannerEmulator(
+			EMULATED_TR, EMULATED_TR_JITTER, EMULATED_TR_DROPOUT,
+			uinput_key = MRI_EMULATED_KEY if SCANNER_EMULATOR == 'uinput' else None
+			)
+	tr_listener = TRSync( # which flags missed, extra and late TRs in ev_log
+		sub, run, UINPUT_NAME if SCANNER_EMULATOR == 'uinput' else KB_NAME,
+		MRI_EMULATED_KEY, TR_POLL_RATE, period = TR_SECONDS,
+		events_log = ev_log,
+		key_source = scanner.key_source if scanner is not None else None,
+		append = resume
+		)
+	if scanner is not None: # its virtual keyboard, before listening on it
+		scanner.start(begin = False) # triggers start with the block
 	tr_listener.start()
 	print('\n\nListening for TRs!\n\n')
 
@@ -310,10 +540,13 @@ if __name__ == '__main__':
 
 	## run a task block
 	if run in ['01']:
-		baseline_block(ui, beh_log, run, tr_listener)
+		baseline_block(ui, beh_log, run, tr_listener, scanner)
 	else:
 		priors = get_priors(sub, run, beh_log.dir)
-		stimulation_block(ui, beh_log, run, tr_listener, priors)
+		stimulation_block(
+			ui, beh_log, run, tr_listener, priors, ckpt_f, resume, ev_log,
+			scanner
+			)
 
 	## notify subject that experiment has ended
 	ui.display(
@@ -327,6 +560,32 @@ if __name__ == '__main__':
 	input('\nPress enter to end script.')
 
 	## clean up and end run
-	tr_listener.stop()
+	if scanner is not None:
+		scanner.stop()
+	tr_stats = tr_listener.stop()
+	if tr_stats is not None and tr_stats['error'] is not None:
+		warn('TR listener failed: %s'%tr_stats['error'])
+	if tr_stats is not None:
+		print('TR listener: %d TRs, %.1f%% CPU, TR %.3f s (jitter sd %.2f ms, '
+			'max %.2f ms), detected %.2f ms after trigger (max %.2f ms)'%(
+			tr_stats['n_TRs'], 100 * tr_stats['cpu_fraction'],
+			tr_stats['TR_median'], 1e3 * tr_stats['TR_jitter_sd'],
+			1e3 * tr_stats['TR_jitter_max'],
+			1e3 * tr_stats['detection_delay_median'],
+			1e3 * tr_stats['detection_delay_max']
+			))
+		print('TR clock: %d volumes, TR %.4f s (jitter %.2f ms); %d missed, '
+			'%d extra, %d late and %d early triggers'%(
+			tr_stats['n_volumes'], tr_stats['TR_estimate'],
+			1e3 * tr_stats['TR_jitter_estimate'], tr_stats['n_TR_missed'],
+			tr_stats['n_TR_extra'], tr_stats['n_TR_late'],
+			tr_stats['n_TR_early']
+			))
 	beh_log.close()
 	ev_log.close()
+	for name, log in (('events', ev_log), ('beh', beh_log)):
+		stats = log.stats()
+		print('%s log: %d rows, at most %d queued, slowest write %.3f ms'%(
+			name, stats['rows_written'], stats['max_queue_depth'],
+			1e3 * stats['max_enqueue_latency']
+			))
@@ -0,0 +1,129 @@
+'''
+Replays recorded stimulation blocks through the adaptive design, with the
+seed and settings the experiment saved alongside each log, and checks
+that the same latencies and posterior estimates come out, trial by trial.
+Reports the first trial at which each replay diverges from the log and
+the per-trial cost of the model update and design choice.
+
+Usage::
+
+    python replay.py logs/sub-01/sub-01_run-02_log-beh.tsv
+    python replay.py logs/sub-*/sub-*_run-0[2-9]_log-beh.tsv --out replay.tsv
+
+Exits with status 1 if any replay diverges, so it can be used as a
+regression test whenever the inference code changes. Values are compared
+as they are written to the log, so a match is exact to the last digit
+logged. Replays of the 'svi' backend are not expected to match, since its
+fits stop on a time budget.
+'''
+from argparse import ArgumentParser
+from time import perf_counter as time
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from util.oed.logistic import LogisticOptimalDesign
+from util.oed.joint import JointOptimalDesign
+
+DESIGNS = dict(
+    LogisticOptimalDesign = LogisticOptimalDesign,
+    JointOptimalDesign = JointOptimalDesign,
+)
+COMPARE = ('latency', 'intensity', 'alpha_mu', 'beta_mu')
+
+def config_path(beh_f):
+    '''
+    where experiment.py saves the design settings for a beh log
+    '''
+    return beh_f.replace('_log-beh.tsv', '_oed.json')
+
+def load_session(beh_f):
+    '''
+    Returns the design settings saved for a recorded block and its
+    stimulation trials, with every logged value kept as the string that
+    was written.
+    '''
+    with open(config_path(beh_f)) as f:
+        config = json.load(f)
+    df = pd.read_csv(beh_f, sep = '\t', dtype = str, keep_default_na = False)
+    return config, df[df.trial_type == 'stimulation'].reset_index(drop = True)
+
+def replay(config, trials, mode = 'bopt'):
+    '''
+    Runs the design through the logged responses in the same order of
+    calls as experiment.stimulation_block, and returns a DataFrame with the
+    logged and replayed value of each compared field, whether each trial
+    matched, and the cost of each update and design choice in ms.
+    '''
+    config = dict(config)
+    design = DESIGNS[config.pop('design')]
+    config['checkpoint'] = None
+    des = design(**config)
+    joint = design is JointOptimalDesign
+    rows = []
+    next_x = des.get_next_x(mode)
+    cost = np.nan # the first design is chosen before the block starts
+    for i, trial in trials.iterrows():
+        params = des.get_param_estimates()
+        replayed = dict(
+            latency = next_x[0] if joint else next_x,
+            intensity = int(next_x[1]) if joint else trial.intensity,
+            alpha_mu = params['alpha_mu'],
+            beta_mu = params['beta_mu'],
+        )
+        row = dict(trial = trial.trial, update_ms = cost)
+        for field in COMPARE:
+            row['%s_logged'%field] = trial[field]
+            row['%s_replayed'%field] = '{}'.format(replayed[field])
+        row['match'] = all(
+            row['%s_logged'%f] == row['%s_replayed'%f] for f in COMPARE
+            )
+        rows.append(row)
+        # continue from what actually happened, as logged
+        if joint:
+            x = (float(trial.latency), float(trial.intensity))
+        else:
+            x = float(trial.latency)
+        y = 1 if trial.pressed_first == 'True' else int(trial.agency)
+        t0 = time()
+        des.update_model(x, y)
+        next_x = des.get_next_x(mode)
+        cost = 1e3 * (time() - t0)
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('beh_files', nargs = '+')
+    parser.add_argument('--mode', default = 'bopt')
+    parser.add_argument('--out', help = 'TSV file to save per-trial results to')
+    args = parser.parse_args()
+
+    results = []
+    for f in args.beh_files:
+        config, trials = load_session(f)
+        t0 = time()
+        res = replay(config, trials, args.mode)
+        elapsed = time() - t0
+        mismatch = res.index[~res.match]
+        if len(mismatch):
+            first = res.loc[mismatch[0]]
+            status = 'DIVERGES at trial %s (%s)'%(first.trial, ', '.join(
+                '%s %s != %s'%(field, first['%s_replayed'%field],
+                                first['%s_logged'%field])
+                for field in COMPARE
+                if first['%s_logged'%field] != first['%s_replayed'%field]
+                ))
+        else:
+            status = 'matches'
+        print('%s: %d trials in %.2f s (update %.2f ms median, %.2f ms max), %s'%(
+            f, len(res), elapsed, res.update_ms.median(), res.update_ms.max(),
+            status
+            ))
+        results.append(res.assign(file = f))
+    results = pd.concat(results, ignore_index = True)
+    if args.out:
+        results.to_csv(args.out, sep = '\t', index = False)
+    sys.exit(0 if results.match.all() else 1)
@@ -0,0 +1,192 @@
+'''
+Runs synthetic observers with known (alpha, beta) through the adaptive
+design and the stimulation block's trial logic, and reports, for each
+trial index, the error of the threshold estimate, the posterior width and
+the wall-clock cost of each model update.
+
+Usage::
+
+    python simulate.py --backend grid --subjects 2000 --trials 120
+    python simulate.py --backend laplace --subjects 200 --out sim.tsv
+
+The 'grid' backend in 'bopt' mode is simulated for many subjects at once
+with array operations; other backends and modes run one subject per task
+in a process pool.
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter as time
+import warnings
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.special import expit
+
+from util.oed.logistic import LogisticOptimalDesign, reparam, inverse_reparam
+from util.oed.grid import GridPosterior
+from util.oed.bernoulli import threshold_probabilities
+
+CANDIDATES = np.arange(0, 1000) # as in experiment.py
+
+def make_observers(n, seed = 0, rt_mean = 300, rt_sd = 40,
+                    alpha_offset = -40, alpha_sd = 30,
+                    beta_mean = 0.017, beta_sd = 0.005):
+    '''
+    Draws n synthetic observers. Each has a mean natural reaction time, and
+    an agency threshold alpha that sits alpha_offset ms from it, give or
+    take alpha_sd; slopes beta are log-normal around beta_mean. Also
+    returns the priors experiment.get_priors would build for each one from
+    their baseline block.
+    '''
+    rng = np.random.default_rng(seed)
+    obs = pd.DataFrame(dict(
+        rt_mean = rng.normal(rt_mean, rt_sd, n),
+        rt_sd = np.full(n, float(rt_sd)),
+        beta = rng.lognormal(*reparam(beta_mean, beta_sd), n),
+    ))
+    obs['alpha'] = obs.rt_mean + alpha_offset + rng.normal(0, alpha_sd, n)
+    priors = dict(
+        alpha_mean = obs.rt_mean + alpha_offset, # as in get_priors for run 02
+        alpha_scale = obs.rt_sd,
+        beta_mean = np.full(n, beta_mean),
+        beta_scale = np.full(n, beta_sd),
+    )
+    return obs, pd.DataFrame(priors)
+
+def run_trial(x, alpha, beta, rt_mean, rt_sd, rng):
+    '''
+    One stimulation trial: the observer presses on their own if their
+    reaction time beats the stimulation latency x, and otherwise judges
+    agency with probability expit(beta * (x - alpha)). As in
+    stimulation_block, self-caused presses count as agency.
+    '''
+    rt = rng.normal(rt_mean, rt_sd)
+    pressed_first = rt < x
+    resp = (rng.random(np.shape(x)) < expit(beta * (x - alpha))).astype(int)
+    return np.where(pressed_first, 1, resp)
+
+def simulate_subject(observer, priors, n_trials, backend, mode, options, seed):
+    '''
+    returns (alpha_mean, alpha_scale, update_seconds) for every trial
+    '''
+    warnings.simplefilter('ignore')
+    rng = np.random.default_rng(seed)
+    des = LogisticOptimalDesign(
+        candidate_designs = CANDIDATES, backend = backend, seed = seed,
+        **options, **priors
+        )
+    out = np.empty((n_trials, 3))
+    for trial in range(n_trials):
+        x = des.get_next_x(mode)
+        y = run_trial(x, observer['alpha'], observer['beta'],
+                        observer['rt_mean'], observer['rt_sd'], rng)
+        t0 = time()
+        des.update_model(x, int(y))
+        out[trial, 2] = time() - t0
+        est = des.get_param_estimates()
+        out[trial, :2] = est['alpha_mean'], est['alpha_scale']
+    return out
+
+def simulate_grid_batch(observers, priors, n_trials, seed, batch_size = 256,
+                        **grid_kwargs):
+    '''
+    Same as simulate_subject with backend = 'grid' and mode = 'bopt', but
+    for a batch of subjects at once: a GridPosterior given every subject's
+    priors holds each one's posterior, and the threshold probabilities,
+    updates and estimates go through the same code as in the experiment,
+    one array operation per trial for the whole batch. Returns an array of
+    shape (n_subjects, n_trials, 3) in which the update time is the batch's
+    time divided by its size.
+    '''
+    rng = np.random.default_rng(seed)
+    amu, asd = reparam(priors.alpha_mean.values, priors.alpha_scale.values)
+    bmu, bsd = reparam(priors.beta_mean.values, priors.beta_scale.values)
+
+    out = np.empty((len(observers), n_trials, 3))
+    for start in range(0, len(observers), batch_size):
+        obs = observers.iloc[start:start + batch_size]
+        n = len(obs)
+        alpha, beta = obs.alpha.values, obs.beta.values
+        batch = slice(start, start + n)
+        post = GridPosterior(
+            amu[batch], asd[batch], bmu[batch], bsd[batch], **grid_kwargs
+            )
+        for trial in range(n_trials):
+            # Thompson sample, by inverting each subject's CDF over designs
+            prob = threshold_probabilities(CANDIDATES, post.alpha_cdf)
+            idx = (np.cumsum(prob, 1) < rng.random((n, 1))).sum(1)
+            x = CANDIDATES[np.minimum(idx, CANDIDATES.size - 1)]
+            y = run_trial(x, alpha, beta, obs.rt_mean.values,
+                            obs.rt_sd.values, rng)
+            t0 = time()
+            post.update(x[:, None, None], y[:, None, None])
+            out[start:start + n, trial, 2] = (time() - t0) / n
+            est = post.lognormal_params()
+            mean, scale = inverse_reparam(est['alpha_mu'], est['alpha_sigma'])
+            out[start:start + n, trial, 0] = mean
+            out[start:start + n, trial, 1] = scale
+    return out
+
+def simulate(observers, priors, n_trials, backend = 'grid', mode = 'bopt',
+                options = dict(), seed = 0, workers = None):
+    '''
+    Runs every observer through n_trials and summarizes the results by
+    trial index. Returns a DataFrame with the mean signed and absolute
+    error of the posterior mean of alpha, its RMSE, the mean posterior
+    standard deviation of alpha, and the mean update time in ms.
+    '''
+    if backend == 'grid' and mode == 'bopt':
+        res = simulate_grid_batch(observers, priors, n_trials, seed, **options)
+    else:
+        seeds = np.random.SeedSequence(seed).generate_state(len(observers))
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [
+                executor.submit(
+                    simulate_subject, observers.iloc[i].to_dict(),
+                    priors.iloc[i].to_dict(), n_trials, backend, mode,
+                    options, int(seeds[i])
+                )
+                for i in range(len(observers))
+            ]
+            res = np.stack([f.result() for f in futures])
+    err = res[..., 0] - observers.alpha.values[:, None]
+    return pd.DataFrame(dict(
+        trial = np.arange(1, n_trials + 1),
+        alpha_bias = err.mean(0),
+        alpha_mae = np.abs(err).mean(0),
+        alpha_rmse = np.sqrt((err**2).mean(0)),
+        alpha_scale = res[..., 1].mean(0),
+        update_ms = 1e3 * res[..., 2].mean(0),
+    ))
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--backend', default = 'grid')
+    parser.add_argument('--mode', default = 'bopt')
+    parser.add_argument('--subjects', type = int, default = 1000)
+    parser.add_argument('--trials', type = int, default = 120)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    parser.add_argument('--shared-priors', action = 'store_true',
+        help = 'give every subject the population prior, not their own')
+    parser.add_argument('--out', help = 'TSV file to save results to')
+    args = parser.parse_args()
+
+    observers, priors = make_observers(args.subjects, args.seed)
+    if args.shared_priors:
+        priors = priors.mean().to_frame().T.loc[[0] * len(priors)]
+        priors = priors.reset_index(drop = True)
+    t0 = time()
+    res = simulate(
+        observers, priors, args.trials, args.backend, args.mode,
+        seed = args.seed, workers = args.workers
+        )
+    print(res.iloc[np.unique(np.geomspace(1, args.trials, 10).astype(int)) - 1]
+            .to_string(index = False, float_format = '%.2f'))
+    print('\n%d subjects x %d trials in %.1f s'%(
+        args.subjects, args.trials, time() - t0
+        ))
+    if args.out:
+        res.to_csv(args.out, sep = '\t', index = False)
@@ -0,0 +1,156 @@
+'''
+Aligns each run's events, beh and TR logs (whose timestamps all come from
+the same perf_counter clock) and writes BIDS events files, with onsets in
+seconds from the run's first TR.
+
+For every trial, the events file has a 'go' event (the Go! cue, lasting
+until the button press), a 'response' event at the press and, on
+stimulation trials, a 'stimulation' event, each with its trial's
+behavioral data and the index of the volume (TR) it fell in. Events are
+matched to trials, and trials and events to volumes, by binary search
+over the sorted timestamps, all at once per run.
+
+To convert a whole logs directory, one run per process::
+
+    python -m util.bids logs --out bids
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+TASK = 'agency'
+TRIAL_COLUMNS = [
+    'trial', 'block', 'response_time', 'latency', 'intensity',
+    'pressed_first', 'agency',
+]
+COLUMNS = ['onset', 'duration', 'trial_type', 'volume'] + TRIAL_COLUMNS
+
+# descriptions for the BIDS sidecar, for columns beyond onset and duration
+DESCRIPTIONS = dict(
+    trial_type = dict(Levels = dict(
+        go = 'Go! cue, lasting until the button press',
+        response = 'button press',
+        stimulation = 'muscle stimulation pulse',
+    )),
+    volume = dict(Description = 'index (from 0) of the volume the event fell in'),
+    trial = dict(Description = 'trial number within the block'),
+    block = dict(Description = "'baseline' or 'stimulation'"),
+    response_time = dict(Description = 'time from Go! cue to button press',
+                            Units = 's'),
+    latency = dict(Description = 'stimulation latency after the Go! cue',
+                    Units = 'ms'),
+    intensity = dict(Description = 'stimulation intensity', Units = 'mA'),
+    pressed_first = dict(
+        Description = 'whether the subject pressed before stimulation'
+        ),
+    agency = dict(Description = 'whether the subject reported causing the press'),
+)
+
+def align_run(beh, events, trs):
+    '''
+    Returns the BIDS events for one run from its beh, events and TR logs
+    (as DataFrames), sorted by onset.
+    '''
+    tr_t = np.sort(trs.timestamp.values)
+    t0 = tr_t[0]
+    starts = events.timestamp[events.event == 'start'].values
+    stims = events.timestamp[events.event == 'stimulation'].values
+
+    # each beh row is written after its trial's Go! cue, so it belongs to the
+    # last trial to start before it
+    trial_of_row = np.searchsorted(starts, beh.timestamp.values, 'right') - 1
+    info = pd.DataFrame(dict(
+        trial = beh.trial.values,
+        block = beh.trial_type.values,
+        response_time = beh.rt.values / 1e3,
+        latency = beh.get('latency'),
+        intensity = beh.get('intensity'),
+        pressed_first = beh.get('pressed_first'),
+        agency = beh.get('agency'),
+    ), index = trial_of_row)
+    info = info[info.index >= 0]
+    info = info[~info.index.duplicated(keep = 'last')]
+    info = info.reindex(np.arange(starts.size))
+
+    go = info.assign(
+        t = starts, duration = info.response_time, trial_type = 'go'
+        )
+    response = info.assign(
+        t = starts + info.response_time.values, duration = 0.,
+        trial_type = 'response'
+        )
+    stim_trials = np.searchsorted(starts, stims, 'right') - 1
+    stim = info.reindex(stim_trials).assign(
+        t = stims, duration = 0., trial_type = 'stimulation'
+        )
+    out = pd.concat([go, response, stim], ignore_index = True)
+    out = out[out.t.notna()].sort_values('t', kind = 'stable')
+    out['onset'] = out.t - t0
+    volume = np.searchsorted(tr_t, out.t.values, 'right') - 1
+    out['volume'] = pd.array( # none before the first TR
+        np.where(volume >= 0, volume, None), dtype = 'Int64'
+        )
+    return out[COLUMNS].reset_index(drop = True)
+
+def _log_path(log_dir, sub, run, ev_type):
+    return os.path.join(
+        log_dir, 'sub-%s'%sub, 'sub-%s_run-%s_log-%s.tsv'%(sub, run, ev_type)
+        )
+
+def export_run(log_dir, sub, run, out_dir = 'bids', task = TASK):
+    '''
+    Writes one run's BIDS events file and returns its path.
+    '''
+    logs = [
+        pd.read_csv(_log_path(log_dir, sub, run, ev_type), sep = '\t')
+        for ev_type in ('beh', 'events', 'TR')
+    ]
+    events = align_run(*logs)
+    func_dir = os.path.join(out_dir, 'sub-%s'%sub, 'func')
+    os.makedirs(func_dir, exist_ok = True)
+    fpath = os.path.join(
+        func_dir, 'sub-%s_task-%s_run-%s_events.tsv'%(sub, task, run)
+        )
+    events.to_csv(fpath, sep = '\t', index = False, na_rep = 'n/a',
+                    float_format = '%.4f')
+    return fpath
+
+def export(log_dir = 'logs', out_dir = 'bids', task = TASK, workers = None):
+    '''
+    Writes BIDS events files for every run under log_dir that has all
+    three logs, in a process pool, plus a sidecar describing the columns.
+    Returns the paths written.
+    '''
+    runs = []
+    for f in sorted(glob(os.path.join(log_dir, 'sub-*', '*_log-TR.tsv'))):
+        m = re.search(r'sub-([^_]+)_run-([^_]+)_log', os.path.basename(f))
+        sub, run = m.groups()
+        if all(os.path.exists(_log_path(log_dir, sub, run, t))
+                for t in ('beh', 'events')):
+            runs.append((sub, run))
+    os.makedirs(out_dir, exist_ok = True)
+    with open(os.path.join(out_dir, 'task-%s_events.json'%task), 'w') as f:
+        json.dump(DESCRIPTIONS, f, indent = 2)
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [
+            executor.submit(export_run, log_dir, sub, run, out_dir, task)
+            for sub, run in runs
+        ]
+        return [f.result() for f in futures]
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('logs', nargs = '?', default = 'logs')
+    parser.add_argument('--out', default = 'bids')
+    parser.add_argument('--task', default = TASK)
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    args = parser.parse_args()
+    written = export(args.logs, args.out, args.task, args.workers)
+    print('Wrote %d events files to %s'%(len(written), args.out))
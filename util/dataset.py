@@ -0,0 +1,140 @@
+'''
+Converts the experiment's TSV logs into a columnar Parquet dataset, and
+loads from it lazily across subjects and runs.
+
+Each log file becomes one Parquet file at::
+
+    <dataset dir>/<log type>/sub=<sub>/run=<run>/part-0.parquet
+
+with columns typed as pandas parses them ('n/a' is null, and columns that
+are null throughout a file are left out). Loading only reads the columns
+and partitions asked for, and iter_batches streams record batches so
+whole-study analyses run in bounded memory::
+
+    python -m util.dataset logs --out logs/dataset
+
+    from util.dataset import load
+    beh = load('beh', columns = ['sub', 'run', 'latency', 'agency'],
+                filter = ds.field('trial_type') == 'stimulation')
+
+Needs pyarrow.
+'''
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError: # only needed here, not to run the experiment
+    pa = None
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import os
+import re
+
+import pandas as pd
+
+DATASET_DIR = os.path.join('logs', 'dataset')
+LOG_FILE = re.compile(r'sub-(?P<sub>[^_]+)_run-(?P<run>[^_]+)_log-(?P<log>\w+)\.tsv$')
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('util.dataset requires pyarrow')
+
+def export_log(fpath, out_dir = DATASET_DIR):
+    '''
+    Writes one TSV log to its place in the dataset, unless the Parquet file
+    there is already newer. Returns the path written (or None if skipped).
+    '''
+    _require_pyarrow()
+    m = LOG_FILE.search(os.path.basename(fpath))
+    dest_dir = os.path.join(
+        out_dir, m.group('log'), 'sub=%s'%m.group('sub'), 'run=%s'%m.group('run')
+        )
+    dest = os.path.join(dest_dir, 'part-0.parquet')
+    if os.path.exists(dest) and os.path.getmtime(dest) >= os.path.getmtime(fpath):
+        return None
+    df = pd.read_csv(fpath, sep = '\t')
+    df = df.dropna(axis = 1, how = 'all')
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    os.makedirs(dest_dir, exist_ok = True)
+    pq.write_table(table, dest + '.tmp')
+    os.replace(dest + '.tmp', dest)
+    return dest
+
+def export(log_dir = 'logs', out_dir = DATASET_DIR, workers = None):
+    '''
+    Converts every subject's and run's logs under log_dir in a process pool,
+    and returns the paths of the Parquet files written.
+    '''
+    _require_pyarrow()
+    files = sorted(glob(os.path.join(log_dir, 'sub-*', 'sub-*_run-*_log-*.tsv')))
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        written = executor.map(export_log, files, [out_dir] * len(files))
+        return [f for f in written if f is not None]
+
+def open_dataset(log = 'beh', dataset_dir = DATASET_DIR):
+    '''
+    Returns a pyarrow Dataset over one log type for all subjects and runs,
+    without reading any data. Its schema is the union of the files' own,
+    so runs logged before a column was added read it as null; sub and run
+    are string columns taken from the paths.
+    '''
+    _require_pyarrow()
+    partitioning = ds.partitioning(
+        pa.schema([('sub', pa.string()), ('run', pa.string())]), flavor = 'hive'
+        )
+    path = os.path.join(dataset_dir, log)
+    dataset = ds.dataset(path, format = 'parquet', partitioning = partitioning)
+    schemas = [f.physical_schema for f in dataset.get_fragments()]
+    schemas.append(partitioning.schema)
+    try:
+        schema = pa.unify_schemas(schemas, promote_options = 'permissive')
+    except TypeError: # older pyarrow can't promote types
+        schema = pa.unify_schemas(schemas)
+    return ds.dataset(
+        path, schema = schema, format = 'parquet', partitioning = partitioning
+        )
+
+def _filter(filter, subs, runs):
+    for field, values in (('sub', subs), ('run', runs)):
+        if values is not None:
+            expr = ds.field(field).isin(list(values))
+            filter = expr if filter is None else filter & expr
+    return filter
+
+def load(log = 'beh', columns = None, filter = None, subs = None, runs = None,
+            dataset_dir = DATASET_DIR):
+    '''
+    Reads one log type into a DataFrame, with only the given columns and the
+    rows matching filter (a pyarrow.dataset expression) from the given
+    subjects and runs. Partitions and row groups that can't match are
+    skipped without being read.
+    '''
+    dataset = open_dataset(log, dataset_dir)
+    table = dataset.to_table(columns = columns, filter = _filter(filter, subs, runs))
+    return table.to_pandas()
+
+def iter_batches(log = 'beh', columns = None, filter = None, subs = None,
+                    runs = None, batch_size = 2**16, dataset_dir = DATASET_DIR):
+    '''
+    Same as load, but yields DataFrames of at most batch_size rows, so memory
+    use doesn't grow with the size of the study.
+    '''
+    dataset = open_dataset(log, dataset_dir)
+    batches = dataset.to_batches(
+        columns = columns, filter = _filter(filter, subs, runs),
+        batch_size = batch_size
+        )
+    for batch in batches:
+        yield batch.to_pandas()
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('logs', nargs = '?', default = 'logs')
+    parser.add_argument('--out', default = DATASET_DIR)
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    args = parser.parse_args()
+    written = export(args.logs, args.out, args.workers)
+    print('Wrote %d Parquet files to %s'%(len(written), args.out))
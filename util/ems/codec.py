@@ -0,0 +1,299 @@
+'''
+Encodes and decodes the stimulator's serial commands with integer bit
+operations, byte for byte as ems_interface's singlepulse and channellist
+modules build them from strings of binary digits.
+
+Each command is a run of bytes in which only the first has its top bit
+set, and some other bits are always 0 (the first bit of every later byte,
+and a few padding bits), so a command is packed by spreading its fields
+over the bits in between. Every valid single-pulse frame is packed once,
+at import, so single_pulse() only has to look its frame up.
+
+To check the codec against singlepulse for every frame, and against
+channellist's output for a set of init, update and stop commands::
+
+    python -m util.ems.codec
+'''
+import struct
+import warnings
+
+import numpy as np
+
+# type of command (as in ems_interface)
+CHANNEL_INIT = 0
+CHANNEL_UPDATE = 1
+CHANNEL_STOP = 2
+SINGLE_PULSE = 3
+
+SAFETY_LIMIT = 30 # highest single-pulse current (as in singlepulse)
+UPDATE_MAX_CURRENT = 7 # highest channel update current (as in channellist)
+N_CHANNELS = 8
+MAX_WIDTH = 2**9 - 1
+
+# (first bit, number of bits) of the runs of free bits in each kind of
+# frame, counting from the most significant bit; the rest are 0, apart
+# from the start bit (bit 0) of a command's first byte
+_HEADER_RUNS = ((1, 7),)
+_PULSE_RUNS = ((1, 7), (9, 3), (14, 2), (17, 7), (25, 7))
+_INIT_RUNS = ((1, 7), (9, 7), (17, 7), (25, 3), (30, 2), (33, 7), (41, 7))
+_CHANNEL_RUNS = ((0, 8), (9, 7), (17, 7)) # one channel of an update
+
+_WORD = struct.Struct('>I')
+
+def _check(name, value, n_bits):
+    if not 0 <= value < 2**n_bits:
+        raise ValueError('%s must be from 0 to %d, not %r'%(
+            name, 2**n_bits - 1, value
+            ))
+
+def _spread(payload, n_bits, runs, start_bit = True):
+    '''
+    Returns an n_bits-bit word with payload's bits spread, most significant
+    first, over the given runs of bits, and the start bit set.
+    '''
+    word = 1 << (n_bits - 1) if start_bit else 0
+    left = sum(n for _, n in runs) # payload bits not yet placed
+    for first, n in runs:
+        left -= n
+        word |= ((payload >> left) & ((1 << n) - 1)) << (n_bits - first - n)
+    return word
+
+def _gather(word, n_bits, runs):
+    # inverse of _spread; returns the payload
+    payload = 0
+    for first, n in runs:
+        payload = payload << n | (word >> (n_bits - first - n)) & ((1 << n) - 1)
+    return payload
+
+def _pack_single_pulse(channel, width, current):
+    # channel counts from 0 here; works elementwise on numpy arrays too
+    checksum = (channel + width + current) % 32
+    return (0x80 | SINGLE_PULSE << 5 | checksum) << 24 \
+            | (channel << 4 | width >> 7) << 16 | (width & 0x7f) << 8 | current
+
+def _single_pulse_table():
+    channel, width, current = np.meshgrid(
+        np.arange(N_CHANNELS), np.arange(MAX_WIDTH + 1),
+        np.arange(SAFETY_LIMIT + 1), indexing = 'ij'
+        )
+    return _pack_single_pulse(channel, width, current).astype('>u4').tobytes()
+
+# every valid single-pulse frame, 4 bytes each, in (channel, width, current)
+# order
+SINGLE_PULSE_TABLE = _single_pulse_table()
+
+def single_pulse(channel, width, current):
+    '''
+    The frame for a single pulse on a channel (from 1), of a width (in
+    microseconds) and current (in mA). Currents from SAFETY_LIMIT up are
+    lowered to it, with a warning.
+    '''
+    if not 1 <= channel <= N_CHANNELS:
+        raise ValueError('channel must be from 1 to %d, not %r'%(
+            N_CHANNELS, channel
+            ))
+    _check('width', width, 9)
+    if current < 0:
+        raise ValueError('current must be positive, not %r'%current)
+    if current >= SAFETY_LIMIT:
+        if current > SAFETY_LIMIT:
+            warnings.warn('Safety limit of %d exceeded; request of %r lowered'
+                            ' to the limit'%(SAFETY_LIMIT, current))
+        current = SAFETY_LIMIT
+    i = 4 * (((channel - 1) * (MAX_WIDTH + 1) + width) * (SAFETY_LIMIT + 1)
+                + current)
+    return SINGLE_PULSE_TABLE[i:i + 4]
+
+def initialize(n_factor, channels, channels_lf, group_time, main_time):
+    '''
+    The channellist init command (see channellist.initialize).
+    '''
+    for name, value, n_bits in (
+            ('n_factor', n_factor, 3), ('channels', channels, 8),
+            ('channels_lf', channels_lf, 8), ('group_time', group_time, 5),
+            ('main_time', main_time, 11)):
+        _check(name, value, n_bits)
+    checksum = (n_factor + channels + channels_lf + group_time + main_time) % 8
+    payload = (
+        CHANNEL_INIT << 38 | checksum << 35 | n_factor << 32 | channels << 24
+        | channels_lf << 16 | group_time << 11 | main_time
+        )
+    return _spread(payload, 48, _INIT_RUNS).to_bytes(6, 'big')
+
+def update(modes, widths, currents):
+    '''
+    The channellist update command, with the mode, pulse width and current
+    of each channel in turn (see channellist.update). Currents above
+    UPDATE_MAX_CURRENT are lowered to it, with a warning; channellist
+    lowered them only in the checksum.
+    '''
+    if not len(modes) == len(widths) == len(currents):
+        raise ValueError('need a mode, width and current for every channel')
+    capped = []
+    for mode, width, current in zip(modes, widths, currents):
+        _check('mode', mode, 2)
+        _check('width', width, 9)
+        if current < 0:
+            raise ValueError('current must be positive, not %r'%current)
+        if current > UPDATE_MAX_CURRENT:
+            warnings.warn('Channel update current %r lowered to %d'%(
+                current, UPDATE_MAX_CURRENT
+                ))
+            current = UPDATE_MAX_CURRENT
+        capped.append(current)
+    checksum = (sum(modes) + sum(widths) + sum(capped)) % 32
+    frame = bytearray([_spread(CHANNEL_UPDATE << 5 | checksum, 8, _HEADER_RUNS)])
+    for mode, width, current in zip(modes, widths, capped):
+        payload = mode << 19 | width << 7 | current
+        frame += _spread(payload, 24, _CHANNEL_RUNS, False).to_bytes(3, 'big')
+    return bytes(frame)
+
+def stop():
+    '''
+    The channellist stop command.
+    '''
+    return bytes([_spread(CHANNEL_STOP << 5, 8, _HEADER_RUNS)])
+
+def _check_padding(frame, word, n_bits, runs, start_bit = True):
+    if _spread(_gather(word, n_bits, runs), n_bits, runs, start_bit) != word:
+        raise ValueError('bad padding bits in %r'%bytes(frame))
+
+def _check_sum(frame, checksum, expected):
+    if checksum != expected:
+        raise ValueError('bad checksum in %r'%bytes(frame))
+
+def decode(data):
+    '''
+    Splits a stream of command bytes into commands, and returns a list of
+    dicts of each one's fields, named as in the encoding functions (with
+    the command's name as 'command'). Raises a ValueError if the stream
+    has a malformed or truncated command or a bad checksum.
+    '''
+    data = bytes(data)
+    commands = []
+    i = 0
+    while i < len(data):
+        if not data[i] & 0x80:
+            raise ValueError('byte %d is not the start of a command'%i)
+        ident = data[i] >> 5 & 3
+        if ident == CHANNEL_UPDATE:
+            end = i + 1
+            while end < len(data) and not data[end] & 0x80:
+                end += 3
+        else:
+            end = i + {SINGLE_PULSE: 4, CHANNEL_INIT: 6, CHANNEL_STOP: 1}[ident]
+        frame = data[i:end]
+        if len(frame) != end - i:
+            raise ValueError('truncated command at byte %d'%i)
+        commands.append(_decode_command(ident, frame))
+        i = end
+    return commands
+
+def _decode_command(ident, frame):
+    if ident == SINGLE_PULSE:
+        word, = _WORD.unpack(frame)
+        _check_padding(frame, word, 32, _PULSE_RUNS)
+        payload = _gather(word, 32, _PULSE_RUNS)
+        channel = payload >> 16 & 7
+        width = payload >> 7 & MAX_WIDTH
+        current = payload & 0x7f
+        _check_sum(frame, payload >> 19 & 31, (channel + width + current) % 32)
+        return dict(
+            command = 'single_pulse', channel = channel + 1, width = width,
+            current = current
+            )
+    if ident == CHANNEL_INIT:
+        word = int.from_bytes(frame, 'big')
+        _check_padding(frame, word, 48, _INIT_RUNS)
+        payload = _gather(word, 48, _INIT_RUNS)
+        fields = dict(
+            n_factor = payload >> 32 & 7, channels = payload >> 24 & 0xff,
+            channels_lf = payload >> 16 & 0xff,
+            group_time = payload >> 11 & 31, main_time = payload & 0x7ff
+            )
+        _check_sum(frame, payload >> 35 & 7, sum(fields.values()) % 8)
+        return dict(command = 'initialize', **fields)
+    if ident == CHANNEL_STOP:
+        if frame[0] & 31:
+            raise ValueError('bad stop command %r'%frame)
+        return dict(command = 'stop')
+    modes, widths, currents = [], [], []
+    for j in range(1, len(frame), 3):
+        word = int.from_bytes(frame[j:j + 3], 'big')
+        _check_padding(frame, word, 24, _CHANNEL_RUNS, start_bit = False)
+        payload = _gather(word, 24, _CHANNEL_RUNS)
+        if payload >> 21 or payload >> 16 & 7:
+            raise ValueError('bad padding bits in %r'%frame)
+        modes.append(payload >> 19 & 3)
+        widths.append(payload >> 7 & MAX_WIDTH)
+        currents.append(payload & 0x7f)
+    _check_sum(
+        frame, frame[0] & 31, (sum(modes) + sum(widths) + sum(currents)) % 32
+        )
+    return dict(
+        command = 'update', modes = modes, widths = widths, currents = currents
+        )
+
+# channellist's output (under Python 2, which it's written for) for some
+# commands, as (function, arguments, hex bytes)
+GOLDEN = [
+    ('stop', (), 'c0'),
+    ('initialize', (0, 0, 0, 0, 0), '800000000000'),
+    ('initialize', (2, 1, 0, 10, 100), '850020012064'),
+    ('initialize', (7, 255, 255, 31, 2047), '8f7f7f737f7f'),
+    ('initialize', (1, 6, 2, 5, 500), '884140205374'),
+    ('update', ([1], [200], [5]), 'ae214805'),
+    ('update', ([0, 3], [100, 511], [7, 2]), 'af006407637f02'),
+    ('update', ([1, 2, 3], [0, 300, 64], [1, 0, 6]), 'b9200001422c00604006'),
+    ('update', ([0], [0], [0]), 'a0000000'),
+]
+
+if __name__ == '__main__':
+
+    from contextlib import redirect_stdout
+    from time import perf_counter as time
+    import io
+
+    from .ems_interface.modules import singlepulse
+
+    n = 0
+    with redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for channel in range(1, N_CHANNELS + 1):
+            for width in range(MAX_WIDTH + 1):
+                for current in range(SAFETY_LIMIT + 5):
+                    frame = single_pulse(channel, width, current)
+                    assert frame == singlepulse.generate(channel, width, current), \
+                        (channel, width, current)
+                    assert decode(frame) == [dict(
+                        command = 'single_pulse', channel = channel,
+                        width = width, current = min(current, SAFETY_LIMIT)
+                        )]
+                    n += 1
+    print('%d single-pulse frames match singlepulse and decode'%n)
+
+    funcs = dict(stop = stop, initialize = initialize, update = update)
+    for name, args, golden in GOLDEN:
+        frame = funcs[name](*args)
+        assert frame.hex() == golden, (name, args, frame.hex())
+        fields = decode(frame)[0]
+        assert fields.pop('command') == name
+        assert tuple(fields.values()) == args, (name, args, fields)
+    stream = b''.join(funcs[name](*args) for name, args, _ in GOLDEN)
+    assert [c['command'] for c in decode(stream)] == [g[0] for g in GOLDEN]
+    print('%d channellist commands match and decode, alone and in a stream'%(
+        len(GOLDEN)
+        ))
+
+    reps = 2000
+    with redirect_stdout(io.StringIO()):
+        t0 = time()
+        for i in range(reps):
+            singlepulse.generate(1, 200, 12)
+        t1 = time()
+    for i in range(reps):
+        single_pulse(1, 200, 12)
+    t2 = time()
+    print('singlepulse.generate: %.1f us per frame; single_pulse: %.2f us'%(
+        1e6 * (t1 - t0) / reps, 1e6 * (t2 - t1) / reps
+        ))
@@ -1,5 +1,5 @@
 from .ems_interface.tools_and_abstractions import SerialThingy
-from .ems_interface.modules import singlepulse
+from . import codec
 from ..ports import find_port
 
 SERIAL_NUMBER = 'HMYID101'
@@ -15,11 +15,20 @@ class EMS:
         self.is_fake = fake
         self.ems = SerialThingy.SerialThingy(fake)
         self.ems.open_port(port, serial_response_active)
+        self._commands = dict() # (intensity, channel, width, repetitions): bytes
 
     def pulse(self, intensity, channel = 1, width = 200, repetitions = 3):
-        one_pulse = singlepulse.generate(channel, width, intensity)
-        for i in range(repetitions):
-            self.ems.write(one_pulse)
+        '''
+        Sends repetitions single-pulse frames in one write. Each distinct
+        pulse's bytes are looked up in codec's table only the first time.
+        '''
+        key = (intensity, channel, width, repetitions)
+        try:
+            command = self._commands[key]
+        except KeyError:
+            command = codec.single_pulse(channel, width, intensity) * repetitions
+            self._commands[key] = command
+        self.ems.write(command)
 
     def close(self):
         if not self.is_fake:
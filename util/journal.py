@@ -0,0 +1,190 @@
+'''
+Append-only journal files for experiment logs, and recovery of clean TSV
+files from them.
+
+A journal starts with a magic line, then holds length-prefixed records::
+
+    <uint32 length> <uint32 crc32> <length bytes of UTF-8 payload>
+
+The first record is a JSON header naming the log's fields, and every
+later record is one tab-separated row. Rows are handed to the OS as soon
+as they are written, and a background thread fsyncs the file within
+fsync_interval seconds of any write (group commit), so a power cut loses
+at most that much of a run while each write stays cheap. A crash can at
+worst leave a torn record at the end, which recovery detects by its
+length or checksum and drops.
+
+Opening a journal that already exists without appending to it (e.g.
+starting a crashed run over) doesn't destroy it: it's renamed to
+<journal>.<n>, and its rows recovered to <log>.tsv.<n>, first.
+
+To rebuild TSVs from the journals under a directory (e.g. after a crash)::
+
+    python -m util.journal logs/sub-01
+'''
+from time import perf_counter as time
+from glob import glob
+import json
+import os
+import struct
+import sys
+import threading
+import warnings
+import zlib
+
+MAGIC = b'TSVJOURNAL1\n'
+_RECORD = struct.Struct('<II') # payload length, crc32 of payload
+
+def _record(payload):
+    return _RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+class JournalWriter:
+
+    def __init__(self, fpath, fields, fsync_interval = .5, append = False):
+        '''
+        Opens a journal for a log with the given fields. If append is True
+        and the journal exists, rows are added after the ones it has, after
+        dropping any torn record a crash left at its end.
+        '''
+        self.fpath = fpath
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        if append and os.path.exists(fpath):
+            _, _, end = read_journal(fpath)
+            self._f = open(fpath, 'r+b')
+            self._f.truncate(end)
+            self._f.seek(end)
+        else:
+            if os.path.exists(fpath):
+                set_aside(fpath)
+            self._f = open(fpath, 'wb')
+            self._f.write(MAGIC)
+            self._f.write(_record(json.dumps(dict(fields = fields)).encode()))
+        self.commit()
+        self._stop = threading.Event()
+        if fsync_interval > 0: # else append commits every time
+            self._committer = threading.Thread(
+                target = self._commit_loop, daemon = True
+                )
+            self._committer.start()
+
+    def append(self, lines):
+        '''
+        adds each line as a record, then commits if one is due
+        '''
+        data = b''.join(_record(line.encode()) for line in lines)
+        with self._lock:
+            self._f.write(data)
+            self._f.flush()
+            self._dirty = True
+        self.commit_if_due()
+
+    def _commit_loop(self):
+        # so rows written just before a lull don't wait for the next write
+        while not self._stop.wait(self.fsync_interval):
+            self.commit_if_due()
+
+    def commit_if_due(self):
+        if self._dirty and time() - self._last_commit >= self.fsync_interval:
+            self.commit()
+
+    def commit(self):
+        '''
+        makes everything written so far durable
+        '''
+        with self._lock:
+            if self._f.closed:
+                return
+            self._f.flush()
+            self._dirty = False
+            fd = self._f.fileno()
+        os.fsync(fd) # without holding up writes
+        self._last_commit = time()
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._stop.set()
+        if self.fsync_interval > 0:
+            self._committer.join()
+        self.commit()
+        self._f.close()
+
+def set_aside(fpath):
+    '''
+    Renames an existing journal to the first free <fpath>.<n>, and writes
+    its rows to <log>.tsv.<n>, warning that it did. Returns the new path.
+    '''
+    n = 1
+    while os.path.exists('%s.%d'%(fpath, n)):
+        n += 1
+    aside = '%s.%d'%(fpath, n)
+    os.replace(fpath, aside)
+    out = '%s.tsv.%d'%(os.path.splitext(fpath)[0], n)
+    try:
+        recover(aside, out)
+        saved = 'its rows are in %s'%out
+    except ValueError: # not even a header survived
+        saved = 'it had no rows to recover'
+    warnings.warn('%s already existed, so it was moved to %s (%s)'%(
+        fpath, aside, saved
+        ))
+    return aside
+
+def read_journal(fpath):
+    '''
+    Returns the fields and rows in a journal, and the byte offset at
+    which its last intact record ends.
+    '''
+    with open(fpath, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('%s is not a log journal'%fpath)
+    pos = len(MAGIC)
+    payloads = []
+    while pos + _RECORD.size <= len(data):
+        length, crc = _RECORD.unpack_from(data, pos)
+        start = pos + _RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break # torn or corrupt tail
+        payloads.append(payload)
+        pos = start + length
+    if not payloads:
+        raise ValueError('%s has no intact header'%fpath)
+    fields = json.loads(payloads[0].decode())['fields']
+    rows = [p.decode() for p in payloads[1:]]
+    return fields, rows, pos
+
+def recover(fpath, out = None):
+    '''
+    Writes the intact rows of a journal to a TSV file (by default, the
+    journal's path with .tsv in place of .journal) and returns how many
+    rows it wrote and how many bytes of torn tail it dropped.
+    '''
+    if out is None:
+        out = os.path.splitext(fpath)[0] + '.tsv'
+    fields, rows, end = read_journal(fpath)
+    with open(out, 'w') as f:
+        f.write('\t'.join(fields))
+        f.write(''.join('\n' + row for row in rows))
+    return len(rows), os.path.getsize(fpath) - end
+
+if __name__ == '__main__':
+
+    paths = sys.argv[1:] or ['logs']
+    journals = []
+    for path in paths:
+        if os.path.isdir(path):
+            journals += sorted(glob(
+                os.path.join(path, '**', '*.journal'), recursive = True
+                ))
+        else:
+            journals.append(path)
+    for fpath in journals:
+        n_rows, dropped = recover(fpath)
+        print('%s: recovered %d rows%s'%(
+            fpath, n_rows, ', dropped %d bytes of torn tail'%dropped
+            if dropped else ''
+            ))
@@ -1,9 +1,15 @@
 from time import perf_counter as time
+from collections import deque
+import threading
 import os
 
+from .journal import JournalWriter, recover
+
 class TSVLogger:
 
-    def __init__(self, sub, run, ev_type, fields, dir = 'logs'):
+    def __init__(self, sub, run, ev_type, fields, dir = 'logs', append = False,
+                    threaded = False, interval = .1, journal = False,
+                    fsync_interval = .5):
         '''
         Opens a TSV file in which to log experiment events.
 
@@ -20,15 +26,59 @@ class TSVLogger:
             A relative directory path. This should be a root directory where all
             subjects' data is to be saved; a subject-specific subdirectory will
             be created within this root directory.
+        append : bool
+            If True and the log file already exists (e.g. when resuming a run
+            after a crash), new lines are added to the end of it instead of
+            overwriting it.
+        threaded : bool
+            If True, write() only puts the row on a queue, and a background
+            thread formats queued rows and writes them out in batches every
+            interval seconds, so callers on a timing-critical path never wait
+            on file I/O. Rows are written in the order write() was called,
+            and everything queued is written by close(). See stats().
+        interval : float
+            How often (in seconds) the background thread writes, if threaded.
+        journal : bool
+            If True, rows go to a crash-safe journal (see util.journal) next
+            to the TSV file instead, which is fsync'd within fsync_interval
+            seconds of each write, and the TSV file is rebuilt from it on
+            close(). If the experiment dies first, rebuild it with
+            ``python -m util.journal``; if the run is started over instead
+            (without append), the old journal is kept and recovered to a
+            side file (see util.journal.set_aside).
         '''
         dir = os.path.join(dir, 'sub-%s'%sub) # subject-level directory
         self.dir = dir 
         if not os.path.exists(dir):
             os.makedirs(dir)
         fpath = os.path.join(dir, 'sub-%s_run-%s_log-%s.tsv'%(sub, run, ev_type))
-        self._f = open(fpath, 'w')
+        self.fpath = fpath
         self._fields = fields
-        self._f.write('\t'.join(self._fields))
+        self._template = '\t'.join(['{%s}'%key for key in fields])
+        self._closed = False
+        if journal:
+            self._f = None
+            self._journal = JournalWriter(
+                os.path.splitext(fpath)[0] + '.journal', fields,
+                fsync_interval, append
+                )
+        elif append and os.path.exists(fpath):
+            self._journal = None
+            self._f = open(fpath, 'a')
+        else:
+            self._journal = None
+            self._f = open(fpath, 'w')
+            self._f.write('\t'.join(self._fields))
+        self.threaded = threaded
+        self._max_depth = 0
+        self._max_enqueue = 0.
+        self._n_written = 0
+        if threaded:
+            self.interval = interval
+            self._queue = deque() # appends and pops are atomic
+            self._stop = threading.Event()
+            self._writer = threading.Thread(target = self._write_loop, daemon = True)
+            self._writer.start()
 
     def write(self, **params):
         '''
@@ -50,18 +100,75 @@ class TSVLogger:
         If you don't include a field specified at initialization, then it will
         be filled in with an 'n/a' automatically.
         '''
+        t = time()
+        if not self.threaded:
+            self._write_lines([self._format(t, params)])
+            self._n_written += 1
+        else:
+            self._queue.append((t, params))
+            depth = len(self._queue)
+            if depth > self._max_depth:
+                self._max_depth = depth
+        dt = time() - t
+        if dt > self._max_enqueue:
+            self._max_enqueue = dt
+
+    def _format(self, t, params):
+        # a missing timestamp is when write() was called
         vals = dict()
         for field in self._fields:
             if field in params:
                 vals[field] = params[field]
             else:
-                vals[field] = time() if field == 'timestamp' else 'n/a'
-        boilerplate = '\n' + '\t'.join(['{%s}'%key for key in self._fields])
-        line = boilerplate.format(**vals)
-        self._f.write(line)
+                vals[field] = t if field == 'timestamp' else 'n/a'
+        return self._template.format(**vals)
+
+    def _write_lines(self, lines):
+        if self._journal is not None:
+            self._journal.append(lines)
+        else:
+            self._f.write(''.join('\n' + line for line in lines))
+
+    def _drain(self):
+        lines = []
+        while self._queue:
+            lines.append(self._format(*self._queue.popleft()))
+        if lines:
+            self._write_lines(lines)
+            if self._f is not None:
+                self._f.flush()
+            self._n_written += len(lines)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self._drain()
+
+    def stats(self):
+        '''
+        The number of rows queued right now and at most (always 0 if not
+        threaded), rows written so far, and the longest any write() took.
+        '''
+        return dict(
+            queue_depth = len(self._queue) if self.threaded else 0,
+            max_queue_depth = self._max_depth,
+            rows_written = self._n_written,
+            max_enqueue_latency = self._max_enqueue,
+        )
 
     def close(self):
-        self._f.close()
+        if self._closed:
+            return
+        self._closed = True
+        if self.threaded:
+            self._stop.set()
+            self._writer.join()
+            self._drain()
+        if self._journal is not None:
+            self._journal.close()
+            recover(self._journal.fpath, self.fpath)
+        else:
+            self._f.close()
 
     def __del__(self):
-        self.close()
+        if not getattr(self, '_closed', True): # False once __init__ got far
+            self.close()
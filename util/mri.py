@@ -1,61 +1,501 @@
 from time import perf_counter as time
-from time import sleep
-from multiprocessing import Process, Event
+from time import process_time, sleep
+from multiprocessing import Process, Event, Queue, Condition, Value, Array
+import queue
 import sys
+import threading
+
+import numpy as np
+from psychtoolbox import GetSecs
 
 from util.logging import TSVLogger
 from .ui import get_keyboard
 
+KB_TIMEOUT = 10. # seconds to keep looking for the trigger keyboard
+LIVENESS_INTERVAL = .5 # how often waits for a TR check the listener is up
 
-def record_TRs(stop_event, start_event, sub, run, kb_name, mri_key):
-	kb = get_keyboard(kb_name)
-	log = TSVLogger(sub, run, 'TR', ['timestamp'])
-	first_TR = True 
-	try: # in case we're interrupted by main process
-		while True:
-			assert(not stop_event.is_set())
+def clock_offset(n = 50):
+	'''
+	Offset to add to a psychtoolbox GetSecs() time (which keyboard events
+	are stamped with) to put it on the perf_counter clock the logs use,
+	taken from the read that was bracketed most tightly by two perf_counter
+	reads.
+	'''
+	best = None
+	for i in range(n):
+		before = time()
+		t = GetSecs()
+		after = time()
+		if best is None or after - before < best[0]:
+			best = (after - before, (before + after)/2 - t)
+	return best[1]
+
+class TRClock:
+
+	def __init__(self, period = None, n_init = 5, alpha = .2, beta = .02,
+					gain = .05, n_sd = 6., tol = .005, n_resync = 3):
+		'''
+		Tracks the scanner's TR period and phase from trigger times, in
+		constant time and memory per pulse, and flags pulses that don't fit.
+
+		Each pulse is matched to the volume it most likely belongs to, from
+		the time of the last volume and the period. Its residual from the
+		predicted time then nudges the phase (by alpha) and the period (by
+		beta), as in an alpha-beta filter, after being clipped to the
+		tolerance so that one bad pulse can't drag the estimate. The
+		tolerance is n_sd times the jitter (a running mean, with weight
+		gain, of absolute residuals) or tol seconds, whichever is larger.
+		Pulses are flagged as:
+
+		TR_missed
+			for each volume that was skipped, at the time it was due
+		TR_extra
+			a pulse less than half a TR after the last volume (it's not
+			counted as a volume and doesn't update the estimates)
+		TR_late, TR_early
+			a pulse further than the tolerance from its predicted time
+
+		If period isn't given, it's estimated from the first n_init
+		intervals (each divided by the number of volumes it most likely
+		spans, so a missed pulse among them doesn't skew it), and pulses are
+		only flagged from then on, along with any volumes missed before. If
+		n_resync pulses in a row are flagged, the estimate is taken to be
+		wrong (or the TR to have changed), and it's made afresh the same way.
+		'''
+		self.period = period
+		self.n_init = n_init
+		self.alpha = alpha
+		self.beta = beta
+		self.gain = gain
+		self.n_sd = n_sd
+		self.tol = tol
+		self.n_resync = n_resync
+		self.jitter = 0.
+		self.anchor = None # (estimated) time of the latest volume
+		self.volume = 0 # volumes so far, including missed ones
+		self.counts = dict(TR_missed = 0, TR_extra = 0, TR_late = 0, TR_early = 0)
+		self._init = [] # pulse times while estimating the period
+		self._n_flagged = 0 # pulses flagged in a row
+
+	def update(self, t):
+		'''
+		Adds a pulse at time t, and returns a list of (event, time) flags.
+		'''
+		if self.anchor is None:
+			self.anchor, self.volume = t, 1
+			self._init = [t]
+			return []
+		if self.period is None:
+			flags = self._estimate(t)
+		elif round((t - self.anchor) / self.period) < 1:
+			flags = [('TR_extra', t)]
+		else:
+			flags = self._track(t)
+		for event, _ in flags:
+			self.counts[event] += 1
+		self._n_flagged = self._n_flagged + 1 if flags else 0
+		if self._n_flagged >= self.n_resync:
+			self.period = None
+			self._init = [self.anchor]
+			self._n_flagged = 0
+		return flags
+
+	def _estimate(self, t):
+		self.volume += 1
+		self.anchor = t
+		self._init.append(t)
+		if len(self._init) <= self.n_init:
+			return []
+		times = np.array(self._init)
+		intervals = np.diff(times)
+		spans = np.maximum(1, np.round(intervals / np.median(intervals)))
+		self.period = np.median(intervals / spans)
+		self.jitter = np.median(np.abs(intervals - spans * self.period))
+		self.volume += int(spans.sum()) - intervals.size
+		self._init = []
+		return [
+			('TR_missed', t0 + i * self.period)
+			for t0, n in zip(times, spans) for i in range(1, int(n))
+			]
+
+	def _track(self, t):
+		k = int(round((t - self.anchor) / self.period))
+		flags = [
+			('TR_missed', self.anchor + i * self.period) for i in range(1, k)
+			]
+		predicted = self.anchor + k * self.period
+		residual = t - predicted
+		tol = max(self.n_sd * self.jitter, self.tol)
+		if abs(residual) > tol:
+			flags.append(('TR_late' if residual > 0 else 'TR_early', t))
+			residual = tol if residual > 0 else -tol
+		self.anchor = predicted + self.alpha * residual
+		self.period += self.beta * residual / k
+		self.jitter += self.gain * (abs(residual) - self.jitter)
+		self.volume += k
+		return flags
+
+	def predict(self, volume):
+		'''
+		predicted time of a volume (counting from 1), or None before the
+		period is known
+		'''
+		if self.period is None:
+			return None
+		return self.anchor + (volume - self.volume) * self.period
+
+class SharedTRs:
+
+	def __init__(self, capacity = 4096):
+		'''
+		The count and times of TRs received so far, and the TRClock's latest
+		estimates, in shared memory, so the listener process can publish
+		each one and any process can read them or wait for a given TR.
+		Waiters sleep on a condition variable that publish() notifies, so
+		they wake as soon as a TR is logged. The last capacity TR times are
+		kept.
+		'''
+		self.capacity = capacity
+		self._cond = Condition()
+		# guarded by _cond
+		self._count = Value('l', 0, lock = False)
+		self._times = Array('d', capacity, lock = False)
+		self._volume = Value('l', 0, lock = False)
+		self._anchor = Value('d', np.nan, lock = False)
+		self._period = Value('d', np.nan, lock = False)
+		self._jitter = Value('d', np.nan, lock = False)
+
+	def publish(self, t, clock = None):
+		with self._cond:
+			n = self._count.value
+			self._times[n % self.capacity] = t
+			self._count.value = n + 1
+			if clock is not None and clock.period is not None:
+				self._volume.value = clock.volume
+				self._anchor.value = clock.anchor
+				self._period.value = clock.period
+				self._jitter.value = clock.jitter
+			self._cond.notify_all()
+
+	def estimates(self):
+		'''
+		the TRClock's volume count, latest volume time, period and jitter
+		(NaN until the period is known)
+		'''
+		with self._cond:
+			return (self._volume.value, self._anchor.value,
+					self._period.value, self._jitter.value)
+
+	@property
+	def count(self):
+		return self._count.value
+
+	def time_of(self, n):
+		'''
+		time of the n-th TR (counting from 1), if it's still held
+		'''
+		with self._cond:
+			count = self._count.value
+			if not count - self.capacity < n <= count:
+				raise IndexError('TR %d is not held (%d received)'%(n, count))
+			return self._times[(n - 1) % self.capacity]
+
+	def wait_for(self, n, timeout = None):
+		'''
+		Blocks until the n-th TR has been received and returns its time,
+		or None if timeout seconds pass first.
+		'''
+		with self._cond:
+			if not self._cond.wait_for(lambda: self._count.value >= n, timeout):
+				return None
+		return self.time_of(n)
+
+def record_TRs(stop_event, trs, sub, run, kb_name, mri_key,
+				poll_rate = 500., stats_queue = None, flag_queue = None,
+				period = None, key_source = None, log_dir = 'logs',
+				append = False):
+	'''
+	Logs a timestamp for every TR trigger (a key press from the scanner)
+	and publishes it, with a TRClock's estimates, to trs (a SharedTRs),
+	until stop_event is set. The clock's flags are put on flag_queue, if
+	given, as dicts of event and timestamp, followed by None on exit.
+
+	Rather than spinning, the keyboard's event queue is checked poll_rate
+	times a second, sleeping in between. Each trigger is timestamped with
+	the time the device saw the key go down, not when the poll found it,
+	so polling more slowly only delays when TRs are published, not their
+	timestamps.
+	Both are logged (as 'timestamp' and 'detected').
+
+	Triggers are read from the keyboard named kb_name, unless key_source
+	is given: any object with the keyboard's getKeys() whose keys' tDown
+	times are already on the perf_counter clock, such as the PipeKeys of
+	a util.scanner.ScannerEmulator.
+
+	If append is True (when resuming a run after a crash), TRs are added to
+	the run's existing TR log rather than replacing it.
+
+	The keyboard is looked for until it appears, for up to KB_TIMEOUT
+	seconds (a virtual one can take a moment to be registered).
+
+	On exit, puts a summary of the listener's CPU use and timing on
+	stats_queue, if given (see TRSync.stop), with the error that stopped
+	it, if any, as 'error'.
+	'''
+	log = None
+	error = None
+	clock = TRClock(period)
+	interval = 1. / poll_rate
+	stamps, delays = [], []
+	cpu0, wall0 = process_time(), time()
+	try:
+		if key_source is None:
+			kb = _find_keyboard(kb_name, KB_TIMEOUT)
+			offset = clock_offset()
+		else:
+			kb = key_source
+			offset = 0.
+		log = TSVLogger(
+			sub, run, 'TR', ['timestamp', 'detected'], dir = log_dir,
+			append = append, journal = True
+			)
+		while not stop_event.wait(interval):
 			keys = kb.getKeys([mri_key], waitRelease = False, clear = True)
-			if keys:
-				t = time()
-				log.write(timestamp = t)
-				if first_TR:
-					start_event.set()
-	except:
-		log.close()
+			if not keys:
+				continue
+			detected = time()
+			for key in keys:
+				t = key.tDown + offset
+				log.write(timestamp = t, detected = detected)
+				flags = clock.update(t)
+				trs.publish(t, clock)
+				if flag_queue is not None:
+					for event, flag_t in flags:
+						flag_queue.put(dict(event = event, timestamp = flag_t))
+				stamps.append(t)
+				delays.append(detected - t)
+	except Exception as e:
+		error = '%s: %s'%(type(e).__name__, e)
+		raise
+	finally:
+		if log is not None:
+			log.close()
+		if flag_queue is not None:
+			flag_queue.put(None)
+		if stats_queue is not None:
+			stats_queue.put(_listener_stats(
+				process_time() - cpu0, time() - wall0, stamps, delays, clock,
+				error
+				))
+
+def _find_keyboard(kb_name, timeout):
+	deadline = time() + timeout
+	while True:
+		try:
+			return get_keyboard(kb_name)
+		except Exception:
+			if time() > deadline:
+				raise
+		sleep(.1)
+
+def _listener_stats(cpu, wall, stamps, delays, clock, error = None):
+	intervals = np.diff(stamps)
+	jitter = np.abs(intervals - np.median(intervals)) if intervals.size \
+				else np.array([np.nan])
+	return dict(
+		n_TRs = len(stamps),
+		cpu_fraction = cpu / wall,
+		TR_median = np.median(intervals) if intervals.size else np.nan,
+		TR_jitter_sd = np.std(intervals) if intervals.size else np.nan,
+		TR_jitter_max = jitter.max(),
+		detection_delay_median = np.median(delays) if delays else np.nan,
+		detection_delay_max = np.max(delays) if delays else np.nan,
+		n_volumes = clock.volume,
+		TR_estimate = clock.period if clock.period is not None else np.nan,
+		TR_jitter_estimate = clock.jitter,
+		error = error,
+		**{'n_' + event: n for event, n in clock.counts.items()}
+	)
 
 class TRSync:
 
-	def __init__(self, sub, run, kb_name, mri_key):
+	def __init__(self, sub, run, kb_name, mri_key, poll_rate = 500.,
+					period = None, events_log = None, key_source = None,
+					log_dir = 'logs', append = False):
+		'''
+		Listens for TR triggers in a separate process (see record_TRs,
+		which also explains key_source, for emulated triggers, and
+		append, for resuming a run).
+		period is the expected TR, if known, for the TRClock that checks
+		the triggers, and pulses it flags as missed, extra, late or early
+		are written to events_log (a TSVLogger with 'event' and 'timestamp'
+		fields), if given, by a thread in this process.
+		'''
 		self.sub = sub
 		self.run = run
 		self.kb_name = kb_name
 		self.mri_key = mri_key
+		self.poll_rate = poll_rate
+		self.period = period
+		self.events_log = events_log
+		self.key_source = key_source
+		self.log_dir = log_dir
+		self.append = append
+		self.stats = None
+		self._process = None
 
 	def start(self):
+		self.stats = None
 		self._stop_event = Event()
-		self._start_event = Event()
+		self._stats_queue = Queue()
+		self._flag_queue = Queue()
+		self.trs = SharedTRs()
 		self._process = Process(
 			target = record_TRs,
 			args = (
-				self._stop_event, self._start_event,
-				 self.sub, self.run, 
-				 self.kb_name, self.mri_key
+				self._stop_event, self.trs,
+				 self.sub, self.run,
+				 self.kb_name, self.mri_key,
+				 self.poll_rate, self._stats_queue,
+				 self._flag_queue, self.period,
+				 self.key_source, self.log_dir, self.append
 				 )
 			)
 		self._process.start()
+		self._flag_writer = threading.Thread(
+			target = self._write_flags, daemon = True
+			)
+		self._flag_writer.start()
+
+	def _write_flags(self):
+		for flag in iter(self._flag_queue.get, None):
+			if self.events_log is not None:
+				self.events_log.write(**flag)
 
-	def stop(self):
+	def stop(self, timeout = 5.):
+		'''
+		Stops the listener and returns (and keeps, as self.stats) its
+		summary: the number of TRs, the fraction of a core it used, the
+		median TR interval and how much intervals varied (standard
+		deviation and largest deviation from the median, in seconds), and
+		how long triggers took to be detected after they happened. If the
+		listener failed, 'error' says why.
+		'''
+		if self._process is None:
+			return self.stats
 		self._stop_event.set()
+		try:
+			if self.stats is None: # or _check_alive already has it
+				self.stats = self._stats_queue.get(timeout = timeout)
+		except queue.Empty:
+			pass
 		self._process.join()
+		self._flag_queue.put(None) # in case the listener died before its own
+		self._flag_writer.join()
+		self._process = None
+		return self.stats
 
 	@property
 	def received_first_TR(self):
-		return self._start_event.is_set()
+		return self.trs.count > 0
+
+	@property
+	def n_TRs(self):
+		'''
+		number of TRs received so far
+		'''
+		return self.trs.count
+
+	def last_TR_time(self):
+		'''
+		perf_counter time of the latest TR, or None before the first
+		'''
+		n = self.trs.count
+		return self.trs.time_of(n) if n else None
+
+	def wait_for_TR(self, n, timeout = None):
+		'''
+		Blocks until the n-th TR of the run (counting from 1) arrives, or
+		returns straight away if it already has, and returns its time (or
+		None if timeout seconds pass first). Raises a RuntimeError if the
+		listener stops while waiting, rather than waiting forever.
+		'''
+		deadline = None if timeout is None else time() + timeout
+		while True:
+			wait = LIVENESS_INTERVAL
+			if deadline is not None:
+				wait = max(0., min(wait, deadline - time()))
+			t = self.trs.wait_for(n, wait)
+			if t is not None:
+				return t
+			if deadline is not None and time() >= deadline:
+				return None
+			self._check_alive()
+
+	def _check_alive(self):
+		if self._process is not None and self._process.is_alive():
+			return
+		if self._process is not None:
+			try:
+				self.stats = self._stats_queue.get(timeout = 1.)
+			except queue.Empty:
+				pass
+		error = (self.stats or dict()).get('error')
+		raise RuntimeError('The TR listener has stopped%s.'%(
+			': ' + error if error else ''
+			))
+
+	def wait_until_first_TR(self, timeout = None):
+		'''
+		waits for the run's first TR (see wait_for_TR)
+		'''
+		return self.wait_for_TR(1, timeout)
+
+	@property
+	def n_volumes(self):
+		'''
+		number of volumes so far by the TR clock, counting missed triggers
+		but not extra ones (0 until it knows the period)
+		'''
+		return self.trs.estimates()[0]
+
+	def TR_period(self):
+		'''
+		the TR clock's current estimate of the TR (None until it has one)
+		'''
+		period = self.trs.estimates()[2]
+		return None if np.isnan(period) else period
+
+	def TR_jitter(self):
+		'''
+		the TR clock's current estimate of the mean absolute deviation of
+		triggers from their predicted times (None until it has one)
+		'''
+		jitter = self.trs.estimates()[3]
+		return None if np.isnan(jitter) else jitter
+
+	def predicted_TR_time(self, volume):
+		'''
+		Predicts the time of a volume (counting from 1, as n_volumes does),
+		past or future, from the TR clock's latest estimates, or returns
+		None until it has them.
+		'''
+		last, anchor, period, _ = self.trs.estimates()
+		if np.isnan(period):
+			return None
+		return anchor + (volume - last) * period
 
-	def wait_until_first_TR(self, poll_time = .05):
-		while not self.received_first_TR:
-			sleep(poll_time)
-		return
+	def next_TR_time(self, after = None):
+		'''
+		Predicts the time of the first TR after time `after` (by default,
+		now), or returns None until the TR clock knows the period.
+		'''
+		_, anchor, period, _ = self.trs.estimates()
+		if np.isnan(period):
+			return None
+		after = time() if after is None else after
+		steps = max(1, np.floor((after - anchor) / period) + 1)
+		return anchor + steps * period
 
 	def __del__(self):
 		self.stop()
@@ -0,0 +1,67 @@
+import numpy as np
+from scipy.special import expit, ndtr
+
+def log_likelihood(x, y, a, b):
+    '''
+    log probability of binary response y to design x under the logistic
+    model p(y = 1) = expit(b * (x - a)), broadcasting over a and b
+    '''
+    logit_p = b * (x - a)
+    sign = 2*y - 1 # log p(y) = log expit(sign * logit_p) for y in {0, 1}
+    return -np.logaddexp(0., -sign * logit_p)
+
+def _entropy(p):
+    '''
+    entropy (in nats) of a Bernoulli distribution with probability p
+    '''
+    p = np.clip(p, 1e-12, 1 - 1e-12)
+    return -(p * np.log(p) + (1 - p) * np.log(1 - p))
+
+def information_gain(x, a, b, w, chunk_size = 2**22):
+    '''
+    Mutual information between y and (alpha, beta) for each design in x,
+    given a weighted point set (a, b, w) approximating the posterior.
+
+    Uses EIG(x) = H[E p(y|x)] - E H[p(y|x)], which is exact for the
+    Bernoulli likelihood up to the accuracy of the point set. Work is
+    chunked over designs so memory stays bounded for large point sets.
+    '''
+    x = np.asarray(x, dtype = float)
+    w = w / w.sum()
+    eig = np.empty(x.shape[0])
+    step = max(1, chunk_size // max(1, a.shape[0]))
+    for i in range(0, x.shape[0], step):
+        p = expit(b[:, None] * (x[None, i:i + step] - a[:, None]))
+        p_marginal = w @ p
+        eig[i:i + step] = _entropy(p_marginal) - w @ _entropy(p)
+    return eig
+
+def lognormal_cdf(v, mu, sigma):
+    '''
+    CDF of a log-normal distribution with log-scale parameters mu, sigma
+    '''
+    v = np.asarray(v, dtype = float)
+    z = (np.log(np.maximum(v, 1e-300)) - mu) / sigma
+    return np.where(v > 0, ndtr(z), 0.)
+
+def threshold_probabilities(x, alpha_cdf):
+    '''
+    Probability that each candidate in x is the one nearest to the
+    threshold of the logistic model. Since p(y = 1) = .5 exactly when
+    x = alpha, that is the posterior mass of alpha falling between the
+    midpoints on either side of each candidate, which only needs the
+    CDF of alpha at the n_candidates - 1 midpoints.
+
+    If alpha_cdf returns one row per posterior (as a batched GridPosterior
+    does), so does this.
+    '''
+    x = np.asarray(x, dtype = float)
+    order = np.argsort(x)
+    xs = x[order]
+    cdf = alpha_cdf((xs[1:] + xs[:-1]) / 2)
+    edge = np.zeros_like(cdf[..., :1])
+    p = np.diff(np.concatenate([edge, cdf, edge + 1.], -1), axis = -1)
+    p = np.maximum(p, 0.)
+    prob = np.empty_like(p)
+    prob[..., order] = p / p.sum(-1, keepdims = True)
+    return prob
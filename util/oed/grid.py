@@ -0,0 +1,158 @@
+import numpy as np
+from scipy.special import logsumexp
+
+from .bernoulli import log_likelihood
+
+class GridPosterior:
+
+    def __init__(self, alpha_mu, alpha_sigma, beta_mu, beta_sigma,
+                    n_alpha = 250, n_beta = 80, n_sd = 4., rng = None):
+        '''
+        Exact posterior over the logistic model's (alpha, beta), discretized
+        on a fixed 2-D grid. Each update adds the log-likelihood of one new
+        observation to every grid node, so the cost of an update depends
+        only on the grid size and not on how many trials came before.
+
+        The grid is spaced evenly in log space and spans n_sd prior
+        standard deviations around the log-normal prior means, so the
+        prior is a normal density on the grid and every cell has the same
+        volume. Posterior mass that would fall outside the grid is lost, so
+        n_sd should be generous when the priors are not well centred.
+
+        Params are the log-normal prior parameters, as from `reparam`, and
+        rng is the numpy Generator to sample with (a fresh one by default).
+
+        Given arrays of prior parameters instead, it holds one posterior
+        per entry (each on its own grid), stacked along a leading axis, and
+        update, alpha_cdf and lognormal_params work on them one row at a
+        time, as simulate.py uses to run many subjects at once.
+        '''
+        self.rng = np.random.default_rng() if rng is None else rng
+        alpha_mu, alpha_sigma, beta_mu, beta_sigma = [
+            np.asarray(p, dtype = float)
+            for p in (alpha_mu, alpha_sigma, beta_mu, beta_sigma)
+            ]
+        self.log_a = np.linspace(
+            alpha_mu - n_sd*alpha_sigma, alpha_mu + n_sd*alpha_sigma, n_alpha,
+            axis = -1
+            )
+        self.log_b = np.linspace(
+            beta_mu - n_sd*beta_sigma, beta_mu + n_sd*beta_sigma, n_beta,
+            axis = -1
+            )
+        la, lb = self._set_nodes()
+        per_node = lambda p: p[..., None, None]
+        self.log_post = -0.5 * (
+            ((la - per_node(alpha_mu)) / per_node(alpha_sigma))**2 +
+            ((lb - per_node(beta_mu)) / per_node(beta_sigma))**2
+            )
+        self._normalize()
+
+    def __getstate__(self):
+        # the rest is cheap to recompute, so keep checkpoints small
+        return dict(log_a = self.log_a, log_b = self.log_b,
+                    log_post = self.log_post, rng = self.rng)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_nodes()
+        self.w = np.exp(self.log_post)
+
+    def _set_nodes(self):
+        la, lb = np.broadcast_arrays(
+            self.log_a[..., :, None], self.log_b[..., None, :]
+            )
+        self.a = np.exp(la)
+        self.b = np.exp(lb)
+        return la, lb
+
+    def _normalize(self):
+        self.log_post -= logsumexp(self.log_post, axis = (-2, -1),
+                                    keepdims = True)
+        self.w = np.exp(self.log_post)
+
+    def update(self, x, y):
+        '''
+        adds the log-likelihood of observing y at design x to the posterior
+        (for a batch, x and y have shape (n, 1, 1))
+        '''
+        self.log_post += log_likelihood(x, y, self.a, self.b)
+        self._normalize()
+
+    def nodes(self, max_nodes = None, tol = 1e-12):
+        '''
+        Returns the grid as a weighted point set (a, b, w), leaving out
+        nodes with negligible posterior mass.
+
+        If max_nodes is given, the grid is first cropped to the region
+        holding non-negligible mass and then pooled into blocks (each
+        replaced by its weighted centroid in log space) until at most
+        max_nodes remain, so the point set gets finer as the posterior
+        narrows.
+        '''
+        keep = self.w > tol * self.w.max()
+        if max_nodes is None or keep.sum() <= max_nodes:
+            return self.a[keep], self.b[keep], self.w[keep]
+        ia = np.flatnonzero(keep.any(1))
+        ib = np.flatnonzero(keep.any(0))
+        crop = (slice(ia[0], ia[-1] + 1), slice(ib[0], ib[-1] + 1))
+        w = self.w[crop]
+        la, lb = np.log(self.a[crop]), np.log(self.b[crop])
+        f = int(np.ceil(np.sqrt(w.size / max_nodes)))
+        pad = [(0, -n % f) for n in w.shape]
+        w = np.pad(w, pad)
+        la = np.pad(la, pad, mode = 'edge')
+        lb = np.pad(lb, pad, mode = 'edge')
+        pool = lambda v: v.reshape(
+            v.shape[0] // f, f, v.shape[1] // f, f
+            ).sum((1, 3)).ravel()
+        pooled_w = pool(w)
+        nonzero = pooled_w > 0
+        pooled_w = pooled_w[nonzero]
+        la = pool(w * la)[nonzero] / pooled_w
+        lb = pool(w * lb)[nonzero] / pooled_w
+        return np.exp(la), np.exp(lb), pooled_w
+
+    def alpha_cdf(self, v):
+        '''
+        marginal posterior CDF of alpha, treating the mass of each grid
+        cell as uniform in log space, consistent with `sample`
+        '''
+        da = self.log_a[..., 1:2] - self.log_a[..., :1]
+        marginal = self.w.sum(-1)
+        cum = np.cumsum(marginal, -1)
+        cum = np.concatenate([np.zeros_like(cum[..., :1]), cum], -1)
+        # linear interpolation between cell edges, as np.interp but
+        # for every row of a batch at once
+        pos = (np.log(np.maximum(v, 1e-300)) - self.log_a[..., :1]) / da + .5
+        j = np.clip(np.floor(pos).astype(int), 0, marginal.shape[-1] - 1)
+        frac = np.clip(pos - j, 0., 1.)
+        at = lambda c: np.take_along_axis(c, j, -1)
+        return at(cum) + frac * at(marginal)
+
+    def sample(self, n):
+        '''
+        draws n (alpha, beta) samples, jittered uniformly within grid cells
+        '''
+        idx = self.rng.choice(self.w.size, size = n, p = self.w.ravel())
+        ia, ib = np.unravel_index(idx, self.w.shape)
+        da = self.log_a[1] - self.log_a[0]
+        db = self.log_b[1] - self.log_b[0]
+        la = self.log_a[ia] + da * (self.rng.random(n) - .5)
+        lb = self.log_b[ib] + db * (self.rng.random(n) - .5)
+        return np.exp(la), np.exp(lb)
+
+    def lognormal_params(self):
+        '''
+        Posterior mean and standard deviation of log(alpha) and log(beta),
+        i.e. the closest log-normal fit to each marginal.
+        '''
+        params = dict()
+        for p, grid, axis in (('alpha', self.log_a, -1),
+                                ('beta', self.log_b, -2)):
+            marginal = self.w.sum(axis)
+            mu = (marginal * grid).sum(-1)
+            sigma = np.sqrt((marginal * (grid - mu[..., None])**2).sum(-1))
+            params['%s_mu'%p] = mu
+            params['%s_sigma'%p] = sigma
+        return params
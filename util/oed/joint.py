@@ -0,0 +1,238 @@
+import numpy as np
+from scipy.special import expit
+
+from .bernoulli import _entropy, log_likelihood
+from .logistic import LogisticOptimalDesign, reparam
+from .smc import ParticlePosterior
+
+def joint_information_gain(latencies, intensities, a, b, c, w, intensity_ref,
+                            chunk_size = 2**22):
+    '''
+    Mutual information between y and (alpha, beta, gamma) for every
+    (latency, intensity) pair, given a weighted point set (a, b, c, w)
+    approximating the posterior, as an array of shape
+    (n_latencies, n_intensities).
+
+    All designs at a chunk of intensities are evaluated in one array
+    operation, with chunks sized so that at most about chunk_size response
+    probabilities are held in memory at once.
+    '''
+    latencies = np.asarray(latencies, dtype = float)
+    w = w / w.sum()
+    thresholds = a + c * (np.asarray(intensities, float)[:, None] - intensity_ref)
+    eig = np.empty((thresholds.shape[0], latencies.size))
+    step = max(1, chunk_size // (a.size * latencies.size))
+    for i in range(0, thresholds.shape[0], step):
+        p = expit(b[:, None] * (latencies - thresholds[i:i + step, :, None]))
+        eig[i:i + step] = _entropy(w @ p) - w @ _entropy(p)
+    return eig.T
+
+def joint_threshold_probabilities(latencies, intensities, a, c, w,
+                                    intensity_ref):
+    '''
+    Probability that each latency is the one nearest the threshold at each
+    intensity, as an array of shape (n_latencies, n_intensities) whose
+    columns each sum to 1 / n_intensities. Latencies must be sorted. Each
+    point's threshold at every intensity is binned between the midpoints
+    of neighbouring latencies, and all bins are counted at once.
+    '''
+    n_lat, n_int = len(latencies), len(intensities)
+    mids = (latencies[1:] + latencies[:-1]) / 2
+    thresholds = a + c * (np.asarray(intensities, float)[:, None] - intensity_ref)
+    bins = np.searchsorted(mids, thresholds) + n_lat * np.arange(n_int)[:, None]
+    p = np.bincount(
+        bins.ravel(), weights = np.broadcast_to(w, bins.shape).ravel(),
+        minlength = n_lat * n_int
+        ).reshape(n_int, n_lat)
+    return p.T / (n_int * w.sum())
+
+class JointParticlePosterior(ParticlePosterior):
+
+    def __init__(self, alpha_mu, alpha_sigma, beta_mu, beta_sigma,
+                    gamma_mean, gamma_scale, intensity_ref, **kwargs):
+        '''
+        Particle posterior over the joint model, in which the threshold
+        shifts linearly with stimulation intensity,
+
+            p(y = 1) = expit(beta * (x - alpha - gamma * (i - intensity_ref)))
+
+        so alpha is the threshold at intensity_ref. gamma (ms per unit of
+        intensity) has a normal prior; alpha and beta are log-normal, with
+        log-scale params as from `reparam`. Particles live in
+        (log alpha, log beta, gamma), and kwargs are as for
+        ParticlePosterior.
+        '''
+        super().__init__(alpha_mu, alpha_sigma, beta_mu, beta_sigma, **kwargs)
+        self.intensity_ref = intensity_ref
+        gamma = self.rng.normal(gamma_mean, gamma_scale, self.n_particles)
+        self._set_particles(np.column_stack([self.theta, gamma]))
+
+    def _set_particles(self, theta):
+        super()._set_particles(theta)
+        if theta.shape[1] > 2:
+            self.c = theta[:, 2]
+
+    def _log_likelihood(self, x, y):
+        latency, intensity = x
+        shift = self.c * (intensity - self.intensity_ref)
+        return log_likelihood(latency - shift, y, self.a, self.b)
+
+    def nodes(self, max_nodes = None):
+        '''
+        Returns the particles as a weighted point set (a, b, c, w), thinned
+        to max_nodes equally weighted particles if there are more.
+        '''
+        if max_nodes is None or max_nodes >= self.n_particles:
+            return self.a, self.b, self.c, self.w
+        idx = self._thin(max_nodes)
+        w = np.full(max_nodes, 1 / max_nodes)
+        return self.a[idx], self.b[idx], self.c[idx], w
+
+    def lognormal_params(self):
+        mu = self.w @ self.theta[:, :2]
+        sd = np.sqrt(self.w @ (self.theta[:, :2] - mu)**2)
+        return dict(
+            alpha_mu = mu[0], alpha_sigma = sd[0],
+            beta_mu = mu[1], beta_sigma = sd[1],
+        )
+
+    def gamma_params(self):
+        mean = self.w @ self.c
+        return dict(
+            gamma_mean = mean,
+            gamma_scale = np.sqrt(self.w @ (self.c - mean)**2),
+        )
+
+class JointOptimalDesign(LogisticOptimalDesign):
+
+    def __init__(self, alpha_mean, alpha_scale, beta_mean, beta_scale,
+                    candidate_designs, candidate_intensities,
+                    gamma_mean = 0., gamma_scale = 5., intensity_ref = None,
+                    checkpoint = None, seed = None, **particle_kwargs):
+        '''
+        Chooses stimulation latency and intensity together, from every pair
+        of candidate_designs (latencies) and candidate_intensities, under
+        the joint model of JointParticlePosterior. alpha is the threshold at
+        intensity_ref (by default the highest candidate intensity), and
+        gamma is how far it moves per unit of intensity.
+
+        Has the same interface as LogisticOptimalDesign (including
+        speculate/commit, warmup and checkpoints), except that designs are
+        (latency, intensity) pairs: get_next_x returns one, update_model
+        takes one as x, and the design vectors returned by
+        get_expected_information_gains and get_probability_is_threshold
+        have one pair per row. Threshold probabilities and information
+        gains are computed for the whole grid in one batched operation.
+
+        In 'bopt' mode, the intensity is the one at which the latencies
+        likely to be nearest the threshold are most informative, i.e. with
+        the highest expected information gain averaged over each latency's
+        probability of being nearest the threshold there. The latency is
+        then drawn from those probabilities, as LogisticOptimalDesign does.
+        '''
+        if intensity_ref is None:
+            intensity_ref = np.max(candidate_intensities)
+        self._init_kwargs = dict(
+            alpha_mean = alpha_mean, alpha_scale = alpha_scale,
+            beta_mean = beta_mean, beta_scale = beta_scale,
+            candidate_designs = candidate_designs,
+            candidate_intensities = candidate_intensities,
+            gamma_mean = gamma_mean, gamma_scale = gamma_scale,
+            intensity_ref = intensity_ref, checkpoint = checkpoint,
+            seed = seed, **particle_kwargs
+            )
+        alpha_mu, alpha_sigma = reparam(alpha_mean, alpha_scale)
+        beta_mu, beta_sigma = reparam(beta_mean, beta_scale)
+
+        self.backend = 'joint'
+        self.rng = np.random.default_rng(seed)
+        self.checkpoint = checkpoint
+        self._speculation = None
+        self.diagnostics_ = []
+        self._block_t0 = None
+        self._block_elapsed = 0.
+        self.posterior_ = JointParticlePosterior(
+            alpha_mu, alpha_sigma, beta_mu, beta_sigma,
+            gamma_mean, gamma_scale, intensity_ref, rng = self.rng,
+            **particle_kwargs
+            )
+        self._set_params(self.posterior_.lognormal_params())
+        self.xs = np.empty((0, 2))
+        self.ys = np.array([])
+        self.latencies = np.sort(candidate_designs).astype(float)
+        self.intensities = np.sort(candidate_intensities).astype(float)
+        lat, inten = np.meshgrid(self.latencies, self.intensities, indexing = 'ij')
+        self._set_candidates(np.column_stack([lat.ravel(), inten.ravel()]))
+        self.adaptive_candidates = False
+
+    def _candidates(self):
+        return self.cd_
+
+    def _set_candidates(self, x):
+        self.cd_ = x
+
+    def _fit(self, x, y):
+        self.xs = np.vstack([self.xs, x])
+        self.ys = np.append(self.ys, y)
+        self.posterior_.update(x, y)
+        self._set_params(self.posterior_.lognormal_params())
+        return dict(
+            fit_iters = 1, fit_elbo = np.nan, fit_elbo_trend = np.nan,
+            fit_converged = True
+            )
+
+    def get_expected_information_gains(self, max_nodes = 500):
+        '''
+        Returns the (latency, intensity) design pairs and the expected
+        information gain about (alpha, beta, gamma) from observing y at
+        each, using max_nodes particles.
+        '''
+        a, b, c, w = self.posterior_.nodes(max_nodes)
+        eig = joint_information_gain(
+            self.latencies, self.intensities, a, b, c, w,
+            self.posterior_.intensity_ref
+            )
+        return self._candidates(), eig.ravel()
+
+    def get_probability_is_threshold(self, method = 'analytic'):
+        '''
+        Returns the (latency, intensity) design pairs and the probability
+        that each latency is nearest to the threshold at its intensity,
+        with intensities equally likely.
+        '''
+        if method != 'analytic':
+            raise ValueError("method must be 'analytic' for the joint design!")
+        post = self.posterior_
+        prob = joint_threshold_probabilities(
+            self.latencies, self.intensities, post.a, post.c, post.w,
+            post.intensity_ref
+            )
+        return self._candidates(), prob.ravel()
+
+    def get_next_x(self, mode = 'bopt', **kwargs):
+        '''
+        outputs the (latency, intensity) pair that optimizes experimenter
+        objective; modes are as for LogisticOptimalDesign (see the class
+        docstring for how 'bopt' picks the intensity), and kwargs go to
+        get_expected_information_gains
+        '''
+        if mode == 'oed':
+            x, eig = self.get_expected_information_gains(**kwargs)
+            which = np.argmax(eig)
+        elif mode == 'bopt':
+            x, prob_5050 = self.get_probability_is_threshold()
+            shape = (self.latencies.size, self.intensities.size)
+            prob = prob_5050.reshape(shape)
+            prob = prob / prob.sum(0) # given each intensity
+            _, eig = self.get_expected_information_gains(**kwargs)
+            intensity = np.argmax((prob * eig.reshape(shape)).sum(0))
+            latency = self.rng.choice(shape[0], p = prob[:, intensity])
+            which = np.ravel_multi_index((latency, intensity), shape)
+        else:
+            raise ValueError("mode must be either 'oed' or 'bopt'!")
+        return tuple(x[which])
+
+    def get_param_estimates(self):
+        params = super().get_param_estimates()
+        params.update(self.posterior_.gamma_params())
+        return params
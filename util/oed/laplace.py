@@ -0,0 +1,131 @@
+import numpy as np
+from numpy.polynomial.hermite_e import hermegauss
+from scipy.special import expit
+
+from .bernoulli import log_likelihood, lognormal_cdf
+
+def gauss_hermite_nodes(mean, cov, n = 20):
+    '''
+    Tensor-product Gauss-Hermite rule for a bivariate normal in
+    (log alpha, log beta), returned as a weighted point set (a, b, w)
+    in the original scale.
+    '''
+    t, wt = hermegauss(n)
+    z = np.stack([np.repeat(t, n), np.tile(t, n)])
+    w = np.outer(wt, wt).ravel()
+    theta = mean[:, None] + np.linalg.cholesky(cov) @ z
+    return np.exp(theta[0]), np.exp(theta[1]), w / w.sum()
+
+class LaplacePosterior:
+
+    def __init__(self, alpha_mu, alpha_sigma, beta_mu, beta_sigma,
+                    max_iters = 20, tol = 1e-8, rng = None):
+        '''
+        Laplace approximation to the posterior over (log alpha, log beta).
+
+        With log-normal priors, the log posterior is smooth in log space, so
+        a few Newton iterations (warm-started from the previous trial's mode)
+        find its mode, and the inverse of the negative Hessian there gives
+        the covariance. Each update is O(num_trials) per Newton iteration,
+        which takes well under a millisecond for a block's worth of trials.
+
+        Params are the log-normal prior parameters, as from `reparam`, and
+        rng is the numpy Generator to sample with (a fresh one by default).
+        '''
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.prior_mean = np.array([alpha_mu, beta_mu], dtype = float)
+        self.prior_prec = 1 / np.array([alpha_sigma, beta_sigma])**2
+        self.max_iters = max_iters
+        self.tol = tol
+        self.xs = np.array([])
+        self.ys = np.array([])
+        self.mode = self.prior_mean.copy()
+        self.cov = np.diag(1 / self.prior_prec)
+        self.n_iters = 0
+        self.converged = True
+
+    def log_posterior(self, theta):
+        a, b = np.exp(theta)
+        ll = log_likelihood(self.xs, self.ys, a, b).sum()
+        prior = -0.5 * self.prior_prec @ (theta - self.prior_mean)**2
+        return ll + prior
+
+    def _grad_hess(self, theta, fisher = False):
+        '''
+        Gradient and Hessian of the log posterior in log space. With
+        fisher = True, the Hessian drops its residual-weighted term so it is
+        always negative definite (i.e. Fisher scoring).
+        '''
+        a, b = np.exp(theta)
+        z = b * (self.xs - a)
+        p = expit(z)
+        r = self.ys - p
+        dz = np.stack([-a * b * np.ones_like(z), z]) # d logit / d theta
+        grad = dz @ r - self.prior_prec * (theta - self.prior_mean)
+        hess = -(dz * p * (1 - p)) @ dz.T - np.diag(self.prior_prec)
+        if not fisher:
+            s = -a * b * r.sum()
+            hess += np.array([[s, s], [s, z @ r]])
+        return grad, hess
+
+    def _precision(self, theta):
+        _, hess = self._grad_hess(theta)
+        if np.all(np.linalg.eigvalsh(-hess) > 0):
+            return -hess
+        _, hess = self._grad_hess(theta, fisher = True)
+        return -hess
+
+    def update(self, x, y):
+        '''
+        adds observation y at design x, then re-finds the posterior mode
+        '''
+        self.xs = np.append(self.xs, x)
+        self.ys = np.append(self.ys, y)
+        theta = self.mode
+        lp = self.log_posterior(theta)
+        converged = False
+        for i in range(self.max_iters):
+            grad, _ = self._grad_hess(theta)
+            step = np.linalg.solve(self._precision(theta), grad)
+            newton_size = np.abs(step).max()
+            # backtrack until the step actually improves the log posterior
+            for j in range(30):
+                new_lp = self.log_posterior(theta + step)
+                if new_lp >= lp:
+                    break
+                step = step / 2
+            else:
+                # nothing along the step improves on theta, so keep it; it
+                # is only the mode if the full step was already negligible
+                converged = newton_size < self.tol
+                break
+            theta = theta + step
+            lp = new_lp
+            if np.abs(step).max() < self.tol:
+                converged = True
+                break
+        self.n_iters = i + 1
+        self.converged = converged
+        self.mode = theta
+        self.cov = np.linalg.inv(self._precision(theta))
+
+    def nodes(self, max_nodes = 400):
+        n = max(2, int(np.sqrt(max_nodes)))
+        return gauss_hermite_nodes(self.mode, self.cov, n)
+
+    def alpha_cdf(self, v):
+        '''
+        marginal posterior CDF of alpha, which is log-normal
+        '''
+        return lognormal_cdf(v, self.mode[0], np.sqrt(self.cov[0, 0]))
+
+    def sample(self, n):
+        theta = self.rng.multivariate_normal(self.mode, self.cov, n)
+        return np.exp(theta[:, 0]), np.exp(theta[:, 1])
+
+    def lognormal_params(self):
+        sd = np.sqrt(np.diag(self.cov))
+        return dict(
+            alpha_mu = self.mode[0], alpha_sigma = sd[0],
+            beta_mu = self.mode[1], beta_sigma = sd[1],
+        )
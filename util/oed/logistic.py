@@ -1,17 +1,38 @@
-import torch
-from torch.distributions.constraints import positive
+try:
+    import torch
+    from torch.distributions.constraints import positive
 
-import pyro
-import pyro.distributions as dist
-from pyro.contrib.oed.eig import marginal_eig
-from pyro.infer import SVI, JitTrace_ELBO
-from pyro.optim import Adam
-from pyro.util import ignore_jit_warnings
+    import pyro
+    import pyro.distributions as dist
+    from pyro.contrib.oed.eig import marginal_eig
+    from pyro.infer import SVI, JitTrace_ELBO
+    from pyro.optim import Adam
+    from pyro.util import ignore_jit_warnings
+except ImportError: # torch and pyro are only needed for the 'svi' backend
+    torch = None
+
+from concurrent.futures import wait
+from time import perf_counter as time
+import copy
+import os
+import pickle
+import threading
 
-from numpy.random import normal, lognormal
 import numpy as np
 from scipy.special import expit
 
+from .bernoulli import information_gain, lognormal_cdf, threshold_probabilities
+from .grid import GridPosterior
+from .laplace import LaplacePosterior, gauss_hermite_nodes
+from .smc import ParticlePosterior
+
+# numpy-only posterior engines, selected by the `backend` argument
+POSTERIORS = dict(
+    grid = GridPosterior,
+    laplace = LaplacePosterior,
+    smc = ParticlePosterior,
+)
+
 def make_model(a_mean, a_sd, b_mean, b_sd):
     '''
     constructs a univariate logistic regression model with specified priors
@@ -27,6 +48,42 @@ def make_model(a_mean, a_sd, b_mean, b_sd):
             return y
     return model
 
+def elbo_diagnostics(losses, window = 25, tol = 1e-2):
+    '''
+    Summarizes the losses (negative ELBOs) from a run of SVI steps as the
+    final ELBO (averaged over the last window steps), its trend (change
+    per step, fit over that same window), and whether the mean loss
+    changed by less than a fraction tol between the last two windows.
+    '''
+    elbo = -np.asarray(losses[-window:])
+    trend = np.polyfit(np.arange(elbo.size), elbo, 1)[0] if elbo.size > 1 \
+                else np.nan
+    converged = False
+    if len(losses) >= 2 * window:
+        last = np.mean(losses[-2*window:-window])
+        converged = abs(np.mean(losses[-window:]) - last) < tol * abs(last)
+    return dict(
+        fit_iters = len(losses), fit_elbo = float(elbo.mean()),
+        fit_elbo_trend = float(trend), fit_converged = bool(converged)
+        )
+
+def make_masked_model(a_mean, a_sd, b_mean, b_sd):
+    '''
+    Same model as `make_model`, but observations are passed in as
+    fixed-size tensors and only entries where `mask` is True count
+    toward the likelihood, so a compiled trace can be reused as the
+    dataset grows.
+    '''
+    def model(x, y, mask):
+        a = pyro.sample("alpha", dist.LogNormal(a_mean, a_sd))
+        b = pyro.sample("beta", dist.LogNormal(b_mean, b_sd))
+        logit_p = b * (x - a)
+        pyro.sample("y",
+            dist.Bernoulli(logits = logit_p).mask(mask).to_event(1),
+            obs = y
+            )
+    return model
+
 def marginal_guide(design, observation_labels, target_labels):
     # samples observations `y` in shape of design candidate tensor
     q_logit = pyro.param("q_logit", torch.zeros(design.shape[-2:]))
@@ -47,23 +104,126 @@ def inverse_reparam(mu, sigma):
     var = (np.exp(sigma*sigma) - 1) * np.exp(2*mu + sigma*sigma)
     return mean, np.sqrt(var)
 
+def _to_numpy(v):
+    if torch is not None and torch.is_tensor(v):
+        return v.detach().numpy()
+    return np.asarray(v)
+
 
 class LogisticOptimalDesign:
 
     def __init__(self, alpha_mean, alpha_scale,
                     beta_mean, beta_scale,
-                    candidate_designs):
+                    candidate_designs, backend = 'svi',
+                    adaptive_candidates = False, max_candidates = 100,
+                    candidate_tol = 1e-4, checkpoint = None, seed = None,
+                    **backend_kwargs):
         '''
         Builds a univariate logistic regression model that can update
         online and output x's with maximal expected information gain
 
         candidate_designs is shape (num_candidates,), other params are floats
+
+        backend selects how the posterior is approximated:
+            'svi': stochastic variational inference in pyro, refit on
+                    the whole trial history after every observation.
+                    Pass incremental = True to keep one compiled ELBO and
+                    optimizer across trials and stop each refit early
+                    (see `_init_svi` for options).
+            'grid': exact posterior on a discretized (alpha, beta) grid,
+                    updated in constant time per trial (see GridPosterior).
+                    Does not need torch or pyro.
+            'laplace': Gaussian approximation in log space around the
+                    posterior mode, found by a few Newton iterations
+                    per trial (see LaplacePosterior). Does not need
+                    torch or pyro.
+            'smc': weighted particles, reweighted per trial and resampled
+                    only when the effective sample size drops (see
+                    ParticlePosterior). Does not need torch or pyro.
+        Any backend_kwargs are passed to the posterior engine.
+
+        With adaptive_candidates = True, designs are only considered where
+        the posterior puts the threshold, give or take candidate_tol of its
+        mass, padded by the steep part of the response curve. The band is
+        spanned by at most max_candidates designs, so the grid starts out
+        coarse and refines as the posterior narrows, and the cost of
+        choosing a design follows the posterior's width rather than the
+        full range of candidate_designs.
+
+        If checkpoint is a file path, the model's state is saved there after
+        every update (see save_checkpoint), so it can be resumed with
+        load_checkpoint.
+
+        All random draws (Thompson samples, particles, Monte Carlo
+        estimates) come from a numpy Generator seeded with seed, which
+        speculative branches copy, so a given seed and sequence of
+        responses always yields the same designs with numpy backends (svi
+        also draws from torch's RNG, which seed seeds globally, and stops
+        fitting on a time budget, so it may not repeat exactly).
         '''
+        self._init_kwargs = dict(
+            alpha_mean = alpha_mean, alpha_scale = alpha_scale,
+            beta_mean = beta_mean, beta_scale = beta_scale,
+            candidate_designs = candidate_designs, backend = backend,
+            adaptive_candidates = adaptive_candidates,
+            max_candidates = max_candidates, candidate_tol = candidate_tol,
+            checkpoint = checkpoint, seed = seed, **backend_kwargs
+            )
 
         # re-parametrize means for log-normal
         alpha_mu, alpha_sigma = reparam(alpha_mean, alpha_scale)
         beta_mu, beta_sigma = reparam(beta_mean, beta_scale)
 
+        self.backend = backend
+        self.rng = np.random.default_rng(seed)
+        self.checkpoint = checkpoint
+        self._speculation = None
+        self.diagnostics_ = []
+        self._block_t0 = None
+        self._block_elapsed = 0.
+        if backend == 'svi':
+            if seed is not None:
+                torch.manual_seed(seed)
+            self._init_svi(alpha_mu, alpha_sigma, beta_mu, beta_sigma,
+                            candidate_designs, **backend_kwargs)
+        elif backend in POSTERIORS:
+            self.posterior_ = POSTERIORS[backend](
+                alpha_mu, alpha_sigma, beta_mu, beta_sigma, rng = self.rng,
+                **backend_kwargs
+                )
+            self._set_params(self.posterior_.lognormal_params())
+            self.xs = np.array([])
+            self.ys = np.array([])
+        else:
+            raise ValueError("backend must be one of %s!"%(
+                ', '.join(["'svi'"] + ["'%s'"%b for b in POSTERIORS])
+                ))
+        self._all_candidates = np.sort(candidate_designs)
+        self._set_candidates(self._all_candidates)
+        self.adaptive_candidates = adaptive_candidates
+        self.max_candidates = max_candidates
+        self.candidate_tol = candidate_tol
+        if adaptive_candidates:
+            self._refine_candidates()
+
+    def _init_svi(self, alpha_mu, alpha_sigma, beta_mu, beta_sigma,
+                    candidate_designs, incremental = False, capacity = 256,
+                    max_iters = 500, tol = 1e-2, window = 25,
+                    time_budget = 1.):
+        '''
+        In incremental mode, observations go into masked tensors of fixed
+        capacity (doubled if ever exceeded) so that the JIT trace of the
+        ELBO compiles once, and the SVI object and its Adam state persist
+        between trials. Pyro doesn't retrace when the buffers double, and
+        doesn't need to, as the traced model takes their size from its
+        inputs at run time. Each refit then runs at most max_iters steps, but
+        stops early once the mean loss over consecutive windows of `window`
+        steps changes by less than a fraction tol, or once time_budget
+        seconds have passed.
+        '''
+        if torch is None:
+            raise ImportError("the 'svi' backend requires torch and pyro")
+        self._svi_lock = threading.Lock() # guards pyro's global param store
         pyro.clear_param_store()
         self.amu_ = torch.tensor(alpha_mu)
         self.asd_ = torch.tensor(alpha_sigma)
@@ -74,9 +234,7 @@ class LogisticOptimalDesign:
         pyro.clear_param_store()
         self._update_model()
         self._orig_model = self.current_model
-        cd = np.expand_dims(candidate_designs, 1)
-        self.cd_ = torch.tensor(cd)
-        def guide(x):
+        def guide(x, *args):
             '''
             approximates posterior p(alpha,beta|x,y)
             '''
@@ -94,32 +252,167 @@ class LogisticOptimalDesign:
                 pyro.sample("alpha", dist.LogNormal(a_mean, a_sd))
                 pyro.sample("beta", dist.LogNormal(b_mean, b_sd))
         self.guide = guide
+        with pyro.poutine.block(): # register params so state can be saved
+            guide(self.xs)
+        self.incremental = incremental
+        if incremental:
+            self.max_iters = max_iters
+            self.tol = tol
+            self.window = window
+            self.time_budget = time_budget
+            self._masked_model = make_masked_model(
+                self.amu_, self.asd_, self.bmu_, self.bsd_
+                )
+            self._allocate(capacity)
+            self._svi = SVI(self._masked_model, self.guide,
+                            Adam({"lr": .005}), loss = JitTrace_ELBO())
+
+    def _allocate(self, capacity):
+        '''
+        (re)allocates the fixed-capacity data buffers for incremental SVI
+        '''
+        n = self.xs.shape[0]
+        self._x_buf = torch.zeros(capacity)
+        self._y_buf = torch.zeros(capacity)
+        self._mask = torch.zeros(capacity, dtype = torch.bool)
+        self._x_buf[:n] = self.xs
+        self._y_buf[:n] = self.ys
+        self._mask[:n] = True
+
+    def _fit_incremental(self, x, y):
+        n = self.xs.shape[0]
+        if n == self._x_buf.shape[0]: # the trace works for any buffer size
+            self._allocate(2 * n)
+        self._x_buf[n] = x
+        self._y_buf[n] = y
+        self._mask[n] = True
+        self.xs = self._x_buf[:n + 1]
+        self.ys = self._y_buf[:n + 1]
+
+        t0 = time()
+        losses = []
+        last_mean = None
+        for i in range(self.max_iters):
+            losses.append(self._svi.step(self._x_buf, self._y_buf, self._mask))
+            if time() - t0 > self.time_budget:
+                break
+            if len(losses) % self.window == 0:
+                mean = np.mean(losses[-self.window:])
+                if last_mean is not None:
+                    if abs(mean - last_mean) < self.tol * abs(last_mean):
+                        break
+                last_mean = mean
+        return losses
 
     def _update_model(self):
         m = make_model(self.amu_, self.asd_, self.bmu_, self.bsd_)
         self.current_model = m
 
+    def _set_params(self, params):
+        self.amu_ = params['alpha_mu']
+        self.asd_ = params['alpha_sigma']
+        self.bmu_ = params['beta_mu']
+        self.bsd_ = params['beta_sigma']
+
+    def _candidates(self):
+        return np.squeeze(np.asarray(self.cd_, dtype = float))
+
+    def _set_candidates(self, x):
+        cd = np.expand_dims(x, 1)
+        self.cd_ = torch.tensor(cd) if self.backend == 'svi' else cd
+
+    def _refine_candidates(self):
+        '''
+        restricts the active candidates to the band holding all but
+        candidate_tol of the posterior mass of the threshold, padded by
+        the range over which the response curve is steep (where 'oed'
+        finds designs informative), at a spacing of at most
+        max_candidates designs
+        '''
+        x = self._all_candidates
+        cum = np.cumsum(threshold_probabilities(x, self._alpha_cdf))
+        lo = np.searchsorted(cum, self.candidate_tol / 2)
+        hi = min(np.searchsorted(cum, 1 - self.candidate_tol / 2), x.size - 1)
+        beta_mean, _ = inverse_reparam(
+            _to_numpy(self.bmu_), _to_numpy(self.bsd_)
+            )
+        pad = 1.5 / beta_mean # logit(p) = +/- 1.5, the D-optimal designs
+        lo = np.searchsorted(x, x[lo] - pad)
+        hi = np.searchsorted(x, x[hi] + pad, side = 'right')
+        step = int(np.ceil((hi - lo) / self.max_candidates))
+        self._set_candidates(x[lo:hi:step])
+
     def update_model(self, x, y):
         '''
-        Updates current parameter estimates given new data
+        Updates current parameter estimates given new data, and returns a
+        record of how the fit went (also appended to self.diagnostics_):
+        iterations run, final ELBO and its trend per step (svi only), wall
+        time, the change in each log-normal parameter, and whether the fit
+        converged.
         '''
+        before = self._lognormal_params()
+        t0 = time()
+        diagnostics = self._fit(x, y)
+        diagnostics['fit_seconds'] = time() - t0
+        after = self._lognormal_params()
+        for p in after:
+            diagnostics['d_%s'%p] = after[p] - before[p]
+        self.diagnostics_.append(diagnostics)
+        if self.adaptive_candidates:
+            self._refine_candidates()
+        if self.checkpoint is not None:
+            self.save_checkpoint(self.checkpoint)
+        return diagnostics
+
+    def get_diagnostics(self):
+        '''
+        record returned by the most recent model update (or None)
+        '''
+        return self.diagnostics_[-1] if self.diagnostics_ else None
+
+    def _lognormal_params(self):
+        return dict(
+            alpha_mu = float(_to_numpy(self.amu_)),
+            alpha_sigma = float(_to_numpy(self.asd_)),
+            beta_mu = float(_to_numpy(self.bmu_)),
+            beta_sigma = float(_to_numpy(self.bsd_)),
+        )
+
+    def _fit(self, x, y):
+        if self.backend != 'svi':
+            self.xs = np.append(self.xs, x)
+            self.ys = np.append(self.ys, y)
+            self.posterior_.update(x, y)
+            self._set_params(self.posterior_.lognormal_params())
+            # numpy engines have no ELBO, and only Laplace iterates
+            return dict(
+                fit_iters = getattr(self.posterior_, 'n_iters', 1),
+                fit_elbo = np.nan, fit_elbo_trend = np.nan,
+                fit_converged = bool(getattr(self.posterior_, 'converged', True))
+                )
         with ignore_jit_warnings():
             x = torch.tensor(x).float()
             y = torch.tensor(y)
-            # use variational inference to apperoximate posterior
-            self.xs = torch.cat([self.xs, x.expand(1)], dim = 0)
-            self.ys = torch.cat([self.ys, y.expand(1)])
-            conditioned_model = pyro.condition(self._orig_model, {"y": self.ys})
-
-            svi = SVI(conditioned_model,
-                  self.guide,
-                  Adam({"lr": .005}),
-                  loss = JitTrace_ELBO(),
-                  #num_samples = 100
-                  )
-            num_iters = 500
-            for i in range(num_iters):
-                elbo = svi.step(self.xs)
+            if self.incremental:
+                losses = self._fit_incremental(x, y)
+                diagnostics = elbo_diagnostics(losses, self.window, self.tol)
+            else:
+                # use variational inference to apperoximate posterior
+                self.xs = torch.cat([self.xs, x.expand(1)], dim = 0)
+                self.ys = torch.cat([self.ys, y.expand(1)])
+                conditioned_model = pyro.condition(
+                    self._orig_model, {"y": self.ys}
+                    )
+
+                svi = SVI(conditioned_model,
+                      self.guide,
+                      Adam({"lr": .005}),
+                      loss = JitTrace_ELBO(),
+                      #num_samples = 100
+                      )
+                num_iters = 500
+                losses = [svi.step(self.xs) for i in range(num_iters)]
+                diagnostics = elbo_diagnostics(losses)
 
             # update parameter estimates
             self.amu_ = pyro.param("alpha_mean").detach().clone()
@@ -127,7 +420,7 @@ class LogisticOptimalDesign:
             self.bmu_ = pyro.param("beta_mean").detach().clone()
             self.bsd_ = pyro.param("beta_sd").detach().clone()
             self._update_model()
-            return True
+        return diagnostics
 
     def _eig(self, num_steps = 1000, start_lr = 0.1, end_lr = 0.001):
         optimizer = pyro.optim.ExponentialLR({'optimizer': torch.optim.Adam,
@@ -139,18 +432,54 @@ class LogisticOptimalDesign:
                         final_num_samples = 10000)
         return eig
 
-    def get_expected_information_gains(self, **kwargs):
+    def _nodes(self, max_nodes = 1000):
+        '''
+        weighted point set (a, b, w) approximating the current posterior
+        '''
+        if self.backend != 'svi':
+            return self.posterior_.nodes(max_nodes)
+        mean = np.array([_to_numpy(self.amu_), _to_numpy(self.bmu_)])
+        cov = np.diag([_to_numpy(self.asd_)**2, _to_numpy(self.bsd_)**2])
+        return gauss_hermite_nodes(mean, cov, int(np.sqrt(max_nodes)))
+
+    def get_expected_information_gains(self, method = 'quadrature',
+                                        **kwargs):
+        '''
+        Returns design vector x and expected information gain about
+        (alpha, beta) from observing y at each x.
+
+        Methods:
+            'quadrature': deterministic; the mutual information between y
+                    and (alpha, beta) for all candidates at once, summed
+                    over a weighted point set from the posterior
+                    (Gauss-Hermite nodes for log-normal posteriors, the
+                    grid or the particles otherwise). Pass max_nodes to
+                    trade accuracy for speed.
+            'marginal': pyro's variational marginal_eig estimator (svi
+                    backend only); accepts num_steps, start_lr and end_lr.
+        '''
+        x = self._candidates()
+        if method == 'quadrature':
+            eig = information_gain(x, *self._nodes(**kwargs))
+            return x, eig
+        elif method != 'marginal':
+            raise ValueError("method must be either 'quadrature' or 'marginal'!")
+        if self.backend != 'svi':
+            raise ValueError("method 'marginal' needs the 'svi' backend!")
         eig = self._eig(**kwargs).float().detach().numpy()
         eig = np.squeeze(eig)
-        x = self.cd_.float().detach().numpy()
-        x = np.squeeze(x)
         return x, eig
 
+    def _sample_params(self, samples):
+        if self.backend != 'svi':
+            return self.posterior_.sample(samples)
+        a = self.rng.lognormal(self.amu_.numpy(), self.asd_.numpy(), samples)
+        b = self.rng.lognormal(self.bmu_.numpy(), self.bsd_.numpy(), samples)
+        return a, b
+
     def _posterior_predictive(self, x, samples = 1000):
-        xx = np.stack([x for i in range(1000)], axis = 1)
-        a = lognormal(self.amu_.numpy(), self.asd_.numpy(), samples)
-        b = lognormal(self.bmu_.numpy(), self.bsd_.numpy(), samples)
-        logit_p = b * (xx - a)
+        a, b = self._sample_params(samples)
+        logit_p = b * (np.expand_dims(x, -1) - a)
         return logit_p
 
     def posterior_predictive(self, x, **kwargs):
@@ -158,14 +487,28 @@ class LogisticOptimalDesign:
         p = expit(logit_p)
         return p
 
-    def get_probability_is_threshold(self, **kwargs):
+    def _alpha_cdf(self, v):
+        if self.backend != 'svi':
+            return self.posterior_.alpha_cdf(v)
+        return lognormal_cdf(v, _to_numpy(self.amu_), _to_numpy(self.asd_))
+
+    def get_probability_is_threshold(self, method = 'analytic', **kwargs):
         '''
         Returns design vector x and probability that each x is
         (nearest to) the 50/50 threshold of the response probability function
         out of the values under consideration.
+
+        Methods:
+            'analytic': exact, from the marginal posterior CDF of alpha
+                    evaluated between neighbouring candidates.
+            'mc': Monte Carlo estimate from posterior samples (pass
+                    `samples` to set how many); works for any model.
         '''
-        x = self.cd_.float().detach().numpy()
-        x = np.squeeze(x)
+        x = self._candidates()
+        if method == 'analytic':
+            return x, threshold_probabilities(x, self._alpha_cdf)
+        elif method != 'mc':
+            raise ValueError("method must be either 'analytic' or 'mc'!")
         logit_p = self._posterior_predictive(x, **kwargs)
         loss = np.abs(logit_p) # p = 50% when logit(p) = 0, so loss is 0 at JND
         prob_min = (loss == loss.min(0)).mean(1) # probability each x is JND
@@ -186,22 +529,237 @@ class LogisticOptimalDesign:
             x, eig = self.get_expected_information_gains(**kwargs)
             which_max = np.argmax(eig)
             next_x = x[which_max]
+        elif mode == 'bopt' and self.backend == 'smc':
+            # a Thompson sample is just one particle, whose threshold is alpha
+            a, _ = self.posterior_.sample(1)
+            x = self._candidates()
+            next_x = x[np.argmin(np.abs(x - a))]
         elif mode == 'bopt':
             x, prob_5050 = self.get_probability_is_threshold(**kwargs)
-            next_x = np.random.choice(x, p = prob_5050)
+            next_x = self.rng.choice(x, p = prob_5050)
         else:
             raise ValueError("mode must be either 'oed' or 'bopt'!")
         return next_x
 
     def get_param_estimates(self):
         params = dict(
-            alpha_mu = self.amu_.detach().numpy(),
-            alpha_sigma = self.asd_.detach().numpy(),
-            beta_mu = self.bmu_.detach().numpy(),
-            beta_sigma = self.bsd_.detach().numpy(),
+            alpha_mu = _to_numpy(self.amu_),
+            alpha_sigma = _to_numpy(self.asd_),
+            beta_mu = _to_numpy(self.bmu_),
+            beta_sigma = _to_numpy(self.bsd_),
         )
         for p in ('alpha', 'beta'):
             mean, std = inverse_reparam(params['%s_mu'%p], params['%s_sigma'%p])
             params['%s_mean'%p] = mean
             params['%s_scale'%p] = std
         return params
+
+    def _get_state(self):
+        '''
+        snapshot of everything that update_model changes
+        '''
+        state = dict(
+            params = (self.amu_, self.asd_, self.bmu_, self.bsd_),
+            candidates = self.cd_,
+            rng = copy.deepcopy(self.rng),
+            )
+        if self.backend != 'svi':
+            state['posterior'] = copy.deepcopy(self.posterior_)
+            state['data'] = (self.xs, self.ys)
+            return state
+        # so speculative branches each draw as update_model would have,
+        # whichever runs first
+        state['torch_rng'] = torch.get_rng_state()
+        store = pyro.get_param_store()
+        state['pyro'] = {
+            name: p.detach().clone() for name, p in store.named_parameters()
+            }
+        state['data'] = (self.xs.clone(), self.ys.clone())
+        if self.incremental:
+            state['buffers'] = (
+                self._x_buf.clone(), self._y_buf.clone(), self._mask.clone()
+                )
+            # including state loaded into a new object that the optimizer
+            # hasn't taken up yet, as it only does on its first step
+            optim = self._svi.optim
+            state['optim'] = {
+                name: copy.deepcopy(o) for name, o in
+                getattr(optim, '_state_waiting_to_be_consumed', {}).items()
+                }
+            state['optim'].update({
+                store.param_name(p): copy.deepcopy(o.state_dict())
+                for p, o in optim.optim_objs.items()
+                })
+        return state
+
+    def _set_state(self, state):
+        '''
+        restores a snapshot from _get_state, leaving the snapshot reusable
+        '''
+        self.amu_, self.asd_, self.bmu_, self.bsd_ = state['params']
+        self.cd_ = state['candidates']
+        self.rng = copy.deepcopy(state['rng'])
+        if self.backend != 'svi':
+            self.posterior_ = copy.deepcopy(state['posterior'])
+            self.posterior_.rng = self.rng # one stream, as in __init__
+            self.xs, self.ys = state['data']
+            return
+        self._update_model()
+        if 'torch_rng' in state: # not in checkpoints from before it was
+            torch.set_rng_state(state['torch_rng'])
+        store = pyro.get_param_store()
+        with torch.no_grad(): # in place, so compiled traces stay valid
+            for name, p in store.named_parameters():
+                p.copy_(state['pyro'][name])
+        self.xs, self.ys = [v.clone() for v in state['data']]
+        if self.incremental:
+            self._x_buf, self._y_buf, self._mask = [
+                v.clone() for v in state['buffers']
+                ]
+            n = self.xs.shape[0]
+            self.xs = self._x_buf[:n]
+            self.ys = self._y_buf[:n]
+            optim = self._svi.optim
+            for p in list(optim.optim_objs):
+                name = store.param_name(p)
+                if name in state['optim']:
+                    optim.optim_objs[p].load_state_dict(
+                        copy.deepcopy(state['optim'][name])
+                        )
+                else: # wasn't stepped yet, so start afresh next time
+                    del optim.optim_objs[p]
+            # state for params the optimizer hasn't seen yet (e.g. when
+            # restoring into a new object) is loaded when it first sees them
+            seen = [store.param_name(p) for p in optim.optim_objs]
+            optim.set_state({
+                name: copy.deepcopy(o) for name, o in state['optim'].items()
+                if name not in seen
+                })
+
+    def _branch(self, before, x, y, mode, kwargs):
+        '''
+        fits the posterior as if y were observed at x, on a copy of the
+        design object, and returns the resulting state and next design
+        '''
+        branch = copy.copy(self)
+        branch.checkpoint = None # only the committed branch is saved
+        branch.diagnostics_ = []
+        # svi branches share pyro's global param store, so take turns
+        lock = self._svi_lock if self.backend == 'svi' else threading.Lock()
+        with lock:
+            branch._set_state(before)
+            diagnostics = branch.update_model(x, y)
+            next_x = branch.get_next_x(mode, **kwargs)
+            return branch._get_state(), next_x, diagnostics
+
+    def speculate(self, x, executor, mode = 'bopt', **kwargs):
+        '''
+        Starts updating the model and choosing the next design for both
+        possible responses to design x on the given executor, e.g. while
+        the subject is still answering. Call commit(y) once the response
+        is known. Don't use the design object in between.
+
+        With numpy backends, the two branches run in parallel if the
+        executor has two workers; svi branches run one after the other.
+        '''
+        before = self._get_state()
+        self._speculation = {
+            y: executor.submit(self._branch, before, x, y, mode, kwargs)
+            for y in (0, 1)
+            }
+
+    def commit(self, y):
+        '''
+        Adopts the speculative branch for observed response y, as if
+        update_model(x, y) had been called, and returns the next design
+        chosen in that branch.
+        '''
+        wait(self._speculation.values()) # svi branches must both be done
+        state, next_x, diagnostics = self._speculation[y].result()
+        self._speculation = None
+        self._set_state(state)
+        self.diagnostics_.append(diagnostics)
+        if self.checkpoint is not None:
+            self.save_checkpoint(self.checkpoint)
+        return next_x
+
+    def warmup(self, mode = 'bopt', **kwargs):
+        '''
+        Pays the one-off costs of the first update and design choice (JIT
+        tracing of the ELBO, torch kernel and param store initialization)
+        by running both on throwaway data, then restores the posterior (and
+        torch's RNG) as it was. Run it while waiting for the scanner so that
+        the first real trial costs the same as later ones. Returns how long
+        it took.
+        '''
+        t0 = time()
+        before = self._get_state()
+        checkpoint, self.checkpoint = self.checkpoint, None
+        x = self._candidates()
+        self.update_model(x[len(x) // 2], 1)
+        self.get_next_x(mode, **kwargs)
+        self._set_state(before)
+        self.checkpoint = checkpoint
+        self.diagnostics_.pop()
+        self.warmup_time_ = time() - t0
+        return self.warmup_time_
+
+    def start_clock(self):
+        '''
+        Starts (or, after load_checkpoint, resumes) timing the block, so
+        checkpoints can record how far into the block they were taken.
+        '''
+        self._block_t0 = time() - self._block_elapsed
+
+    def get_progress(self):
+        '''
+        number of observations so far and seconds since start_clock
+        '''
+        if self._block_t0 is not None:
+            self._block_elapsed = time() - self._block_t0
+        return dict(trials = len(self.xs), elapsed = self._block_elapsed)
+
+    def save_checkpoint(self, fpath):
+        '''
+        Pickles everything needed to rebuild the model exactly as it is now:
+        constructor arguments, posterior state and data, RNG state (and
+        torch's, for svi), current estimates, and elapsed block time. The file is
+        replaced atomically, so a crash mid-write leaves the last one intact.
+        '''
+        ckpt = dict(
+            init = self._init_kwargs,
+            state = self._get_state(),
+            estimates = self.get_param_estimates(),
+            progress = self.get_progress(),
+            )
+        if self.backend == 'svi':
+            ckpt['torch_rng'] = torch.get_rng_state()
+        tmp = fpath + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(ckpt, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fpath)
+
+    @classmethod
+    def load_checkpoint(cls, fpath, **kwargs):
+        '''
+        Rebuilds a model saved by save_checkpoint, including its RNG
+        state, ready to continue where it stopped. Call start_clock() when
+        the block resumes. kwargs override the saved constructor arguments.
+        '''
+        ckpt = read_checkpoint(fpath)
+        des = cls(**dict(ckpt['init'], **kwargs))
+        des._set_state(ckpt['state'])
+        des._block_elapsed = ckpt['progress']['elapsed']
+        if 'torch_rng' in ckpt:
+            if des.incremental: # the JIT trace draws from torch's RNG, so
+                des.warmup()    # trace now rather than on the next update
+            torch.set_rng_state(ckpt['torch_rng'])
+        return des
+
+def read_checkpoint(fpath):
+    '''
+    Loads a checkpoint written by LogisticOptimalDesign.save_checkpoint
+    as a dict; its 'estimates' and 'progress' entries are plain numbers.
+    '''
+    with open(fpath, 'rb') as f:
+        return pickle.load(f)
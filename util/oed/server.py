@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+import queue
+import threading
+
+from .logistic import LogisticOptimalDesign
+
+# calls the server will answer, by name of the design object's method
+METHODS = (
+    'update_model', 'get_next_x', 'get_param_estimates',
+    'get_probability_is_threshold', 'get_expected_information_gains',
+    'speculate', 'commit', 'warmup',
+    'start_clock', 'get_progress', 'save_checkpoint', 'get_diagnostics',
+)
+
+def serve(requests, responses, design_kwargs, resume = None,
+            design_class = LogisticOptimalDesign):
+    '''
+    Worker process loop: builds the design object (or loads it from the
+    checkpoint file resume), then answers requests of the form
+    (request_id, method, args, kwargs) in order until it receives None.
+    '''
+    if resume is None:
+        des = design_class(**design_kwargs)
+    else:
+        des = design_class.load_checkpoint(resume, **design_kwargs)
+    executor = ThreadPoolExecutor(max_workers = 2) # for speculative branches
+    while True:
+        req = requests.get()
+        if req is None:
+            break
+        rid, method, args, kwargs = req
+        try:
+            if method not in METHODS:
+                raise ValueError('unknown method %s'%method)
+            if method == 'speculate':
+                kwargs['executor'] = executor
+            result = getattr(des, method)(*args, **kwargs)
+            responses.put((rid, None, result))
+        except Exception as e:
+            responses.put((rid, e, None))
+    executor.shutdown()
+
+class DesignServer:
+
+    def __init__(self, timeout = 10., maxsize = 8, resume = None,
+                    design_class = LogisticOptimalDesign, **design_kwargs):
+        '''
+        Runs a LogisticOptimalDesign in its own worker process, so model
+        fitting never competes with the experiment process for the GIL.
+
+        The design object is constructed in the worker from design_kwargs
+        (the same arguments LogisticOptimalDesign takes). Requests and
+        responses travel over queues bounded to maxsize, and calls that
+        can't be sent or answered within timeout seconds raise a
+        TimeoutError. The worker is started with 'spawn', so it begins
+        from a clean interpreter rather than a fork of the PsychoPy one.
+        If resume is a checkpoint file, the worker loads the design from it
+        instead, with design_kwargs overriding the saved arguments. Pass
+        design_class to serve a subclass (e.g. JointOptimalDesign) instead.
+
+        Besides the short names (update, next_x, estimates), the object
+        has the same methods as LogisticOptimalDesign, so it can be used
+        in its place; speculate() ignores its executor argument, since
+        branches run on an executor in the worker.
+        '''
+        self.timeout = timeout
+        self.design_kwargs = design_kwargs
+        self.resume = resume
+        self.design_class = design_class
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._process = None
+
+    def start(self):
+        ctx = mp.get_context('spawn')
+        self._requests = ctx.Queue(self.maxsize)
+        self._responses = ctx.Queue(self.maxsize)
+        self._process = ctx.Process(
+            target = serve,
+            args = (
+                self._requests, self._responses, self.design_kwargs,
+                self.resume, self.design_class
+                ),
+            daemon = True
+            )
+        self._process.start()
+        self._next_id = 0
+        self._abandoned = set()
+        return self
+
+    def call(self, method, *args, timeout = None, **kwargs):
+        '''
+        Sends a request to the worker and waits for its response, raising
+        any exception the call raised in the worker.
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            rid = self._next_id
+            self._next_id += 1
+            try:
+                self._requests.put((rid, method, args, kwargs), timeout = timeout)
+            except queue.Full:
+                raise TimeoutError('design server request queue is full')
+            while True:
+                try:
+                    _rid, err, result = self._responses.get(timeout = timeout)
+                except queue.Empty:
+                    self._abandoned.add(rid) # drop its response if it comes
+                    raise TimeoutError(
+                        'design server did not answer %s within %.1f s'%(
+                            method, timeout
+                        ))
+                if _rid in self._abandoned:
+                    self._abandoned.remove(_rid)
+                    continue
+                break
+        if err is not None:
+            raise err
+        return result
+
+    def update(self, x, y, **kwargs):
+        return self.call('update_model', x, y, **kwargs)
+
+    def next_x(self, mode = 'bopt', **kwargs):
+        return self.call('get_next_x', mode, **kwargs)
+
+    def estimates(self):
+        return self.call('get_param_estimates')
+
+    def speculate(self, x, executor = None, mode = 'bopt', **kwargs):
+        return self.call('speculate', x, mode = mode, **kwargs)
+
+    def commit(self, y):
+        return self.call('commit', y)
+
+    def warmup(self, mode = 'bopt', timeout = 60., **kwargs):
+        # includes the worker's start-up, so allow for slow imports
+        return self.call('warmup', mode, timeout = timeout, **kwargs)
+
+    update_model = update
+    get_next_x = next_x
+    get_param_estimates = estimates
+
+    def get_probability_is_threshold(self, **kwargs):
+        return self.call('get_probability_is_threshold', **kwargs)
+
+    def get_expected_information_gains(self, **kwargs):
+        return self.call('get_expected_information_gains', **kwargs)
+
+    def get_diagnostics(self):
+        return self.call('get_diagnostics')
+
+    def start_clock(self):
+        return self.call('start_clock')
+
+    def get_progress(self):
+        return self.call('get_progress')
+
+    def save_checkpoint(self, fpath):
+        return self.call('save_checkpoint', fpath)
+
+    def close(self, timeout = 5.):
+        '''
+        asks the worker to finish its current request and exit, and
+        terminates it if it hasn't within timeout seconds
+        '''
+        if self._process is None:
+            return
+        try:
+            self._requests.put(None, timeout = timeout)
+        except queue.Full:
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._process = None
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.special import logsumexp
+
+from .bernoulli import log_likelihood
+
+class ParticlePosterior:
+
+    def __init__(self, alpha_mu, alpha_sigma, beta_mu, beta_sigma,
+                    n_particles = 4000, ess_threshold = .5, shrinkage = .95,
+                    rng = None):
+        '''
+        Sequential Monte Carlo (particle filter) posterior over
+        (alpha, beta). Particles are drawn from the log-normal priors and
+        reweighted by the likelihood of each new observation, so an update is
+        O(n_particles) regardless of how many trials came before.
+
+        When the effective sample size falls below ess_threshold *
+        n_particles, particles are resampled and then rejuvenated with a
+        Liu-West kernel move in log space: each particle is shrunk toward the
+        weighted mean by `shrinkage` and jittered with the matching amount of
+        the weighted covariance, which preserves the posterior's first two
+        moments without revisiting the trial history.
+
+        Params are the log-normal prior parameters, as from `reparam`, and
+        rng is the numpy Generator to draw particles with (a fresh one by
+        default).
+        '''
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.n_particles = n_particles
+        self.ess_threshold = ess_threshold
+        self.shrinkage = shrinkage
+        self.theta = self.rng.normal(
+            [alpha_mu, beta_mu], [alpha_sigma, beta_sigma], (n_particles, 2)
+            )
+        self._set_particles(self.theta)
+        self.log_w = np.full(n_particles, -np.log(n_particles))
+        self.w = np.exp(self.log_w)
+        self.n_resamples = 0
+
+    def _set_particles(self, theta):
+        self.theta = theta
+        self.a = np.exp(theta[:, 0])
+        self.b = np.exp(theta[:, 1])
+
+    def ess(self):
+        '''
+        effective sample size of the current particle weights
+        '''
+        return 1 / (self.w @ self.w)
+
+    def update(self, x, y):
+        '''
+        reweights particles by the likelihood of observing y at design x
+        '''
+        self.log_w += self._log_likelihood(x, y)
+        self.log_w -= logsumexp(self.log_w)
+        self.w = np.exp(self.log_w)
+        if self.ess() < self.ess_threshold * self.n_particles:
+            self._resample()
+
+    def _log_likelihood(self, x, y):
+        return log_likelihood(x, y, self.a, self.b)
+
+    def _resample(self):
+        # systematic resampling
+        n = self.n_particles
+        u = (self.rng.random() + np.arange(n)) / n
+        idx = np.searchsorted(np.cumsum(self.w), u)
+        idx = np.minimum(idx, n - 1)
+        # Liu-West kernel move, using moments from before resampling
+        mean = self.w @ self.theta
+        cov = np.cov(self.theta.T, aweights = self.w)
+        jitter = self.rng.multivariate_normal(
+            np.zeros(self.theta.shape[1]), (1 - self.shrinkage**2) * cov, n
+            )
+        theta = self.shrinkage * self.theta[idx] \
+                    + (1 - self.shrinkage) * mean + jitter
+        self._set_particles(theta)
+        self.log_w = np.full(n, -np.log(n))
+        self.w = np.exp(self.log_w)
+        self.n_resamples += 1
+
+    def nodes(self, max_nodes = None):
+        '''
+        Returns the particles as a weighted point set (a, b, w), thinned
+        to max_nodes equally weighted particles by systematic resampling
+        if there are more than that.
+        '''
+        if max_nodes is None or max_nodes >= self.n_particles:
+            return self.a, self.b, self.w
+        idx = self._thin(max_nodes)
+        return self.a[idx], self.b[idx], np.full(max_nodes, 1 / max_nodes)
+
+    def _thin(self, max_nodes):
+        # indices of max_nodes particles, by systematic resampling
+        u = (self.rng.random() + np.arange(max_nodes)) / max_nodes
+        return np.minimum(
+            np.searchsorted(np.cumsum(self.w), u), self.n_particles - 1
+            )
+
+    def alpha_cdf(self, v):
+        '''
+        weighted empirical CDF of the particles' alpha values
+        '''
+        order = np.argsort(self.a)
+        cum = np.append(0., np.cumsum(self.w[order]))
+        return cum[np.searchsorted(self.a[order], v, side = 'right')]
+
+    def sample(self, n):
+        idx = self.rng.choice(self.n_particles, size = n, p = self.w)
+        return self.a[idx], self.b[idx]
+
+    def lognormal_params(self):
+        mu = self.w @ self.theta
+        sd = np.sqrt(self.w @ (self.theta - mu)**2)
+        return dict(
+            alpha_mu = mu[0], alpha_sigma = sd[0],
+            beta_mu = mu[1], beta_sigma = sd[1],
+        )
@@ -0,0 +1,232 @@
+'''
+Emulates an MRI scanner's TR triggers, so runs and timing benchmarks can
+go without a scanner or button box.
+
+A ScannerEmulator process sends a trigger every TR, plus Gaussian jitter,
+dropping each with probability dropout, to one of two places:
+
+- a pipe, read by the PipeKeys key source that record_TRs (and TRSync)
+  can use in place of a keyboard. Each trigger arrives stamped with the
+  time it was sent, so its timestamp in the TR log is the true trigger
+  time and the log's 'detected' column shows how long the listener took
+  to notice it.
+- a virtual keyboard made with uinput (Linux only, needs python-evdev and
+  write access to /dev/uinput), which presses the trigger key like a
+  button box would, so the listener reads it through psychtoolbox as
+  usual. Point the listener's kb_name at UINPUT_NAME.
+
+Like a real scanner, the emulator is set up (and its virtual keyboard
+created) by start(), but only sends triggers once begin() is called, so
+the TR listener can be started in between and a run can start the
+"scan" right before it waits for the first TR. It returns the times it
+sent (and dropped) triggers when it stops. See benchmarks/tr_latency.py.
+'''
+try:
+    from evdev import UInput, ecodes
+except ImportError: # only needed for uinput triggers
+    UInput = None
+
+from time import perf_counter as time
+from multiprocessing import Process, Event, Pipe, Queue
+
+import numpy as np
+
+UINPUT_NAME = 'Scanner emulator'
+SPIN = .002 # how long before a trigger to stop sleeping and spin
+
+class PipeKeys:
+
+    def __init__(self, conn):
+        '''
+        A key source, with the part of psychtoolbox Keyboard's interface
+        that record_TRs uses, for triggers sent down a pipe by a
+        ScannerEmulator. Key times are on the perf_counter clock.
+        '''
+        self._conn = conn
+
+    def getKeys(self, keys = None, waitRelease = False, clear = True):
+        out = []
+        while self._conn.poll():
+            out.append(_Key(self._conn.recv()))
+        return out
+
+class _Key:
+
+    def __init__(self, t):
+        self.tDown = t
+
+class _PipeSink:
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def open(self):
+        pass
+
+    def send(self):
+        t = time()
+        self._conn.send(t)
+        return t
+
+    def close(self):
+        self._conn.close()
+
+class _UInputSink:
+
+    def __init__(self, key):
+        self.code = getattr(ecodes, 'KEY_' + key.upper())
+
+    def open(self): # in the emulator process, as a UInput can't be pickled
+        self._dev = UInput(
+            {ecodes.EV_KEY: [self.code]}, name = UINPUT_NAME
+            )
+
+    def send(self):
+        t = time()
+        self._dev.write(ecodes.EV_KEY, self.code, 1)
+        self._dev.syn()
+        self._dev.write(ecodes.EV_KEY, self.code, 0)
+        self._dev.syn()
+        return t
+
+    def close(self):
+        self._dev.close()
+
+def emulate(stop_event, ready_event, begin_event, sink, TR, jitter,
+                dropout, n_TRs, start_delay, seed, times_queue):
+    '''
+    Opens sink and sets ready_event, then waits for begin_event and sends
+    triggers to sink on a TR schedule from start_delay seconds after that,
+    until stop_event is set or n_TRs (if not None) have been due, then puts
+    the times they were sent, and the times of those dropped, on
+    times_queue.
+
+    Each trigger's time is drawn around its place in the schedule, so
+    jitter doesn't accumulate. The process sleeps until just before it and
+    spins for the rest, to send it on time to within microseconds.
+    '''
+    rng = np.random.default_rng(seed)
+    sent, dropped = [], []
+    sink.open()
+    try:
+        ready_event.set()
+        begin_event.wait() # which stop() also sets
+        t0 = time() + start_delay
+        i = 0
+        while n_TRs is None or i < n_TRs:
+            due = t0 + i * TR + (rng.normal(0., jitter) if jitter else 0.)
+            drop = rng.random() < dropout
+            i += 1
+            if stop_event.wait(max(0., due - time() - SPIN)):
+                break
+            while time() < due:
+                pass
+            if drop:
+                dropped.append(due)
+            else:
+                sent.append(sink.send())
+    finally:
+        sink.close()
+        times_queue.put((sent, dropped))
+
+class ScannerEmulator:
+
+    def __init__(self, TR = 2., jitter = 0., dropout = 0., n_TRs = None,
+                    start_delay = 5., seed = None, uinput_key = None):
+        '''
+        Parameters
+        ----------
+        TR : float
+            Seconds between triggers.
+        jitter : float
+            Standard deviation (in seconds) of each trigger's time around
+            its place in the schedule.
+        dropout : float
+            Probability of each trigger not being sent.
+        n_TRs : int
+            How many TRs to run for, or None to go on until stop().
+        start_delay : float
+            Seconds from begin() to the first trigger.
+        seed : int
+            Seed for the jitter and dropout.
+        uinput_key : str
+            If given, triggers press this key on a uinput virtual keyboard
+            instead of going to key_source.
+        '''
+        self.TR = TR
+        self.jitter = jitter
+        self.dropout = dropout
+        self.n_TRs = n_TRs
+        self.start_delay = start_delay
+        self.seed = seed
+        self.uinput_key = uinput_key
+        self.times = None
+        self._process = None
+        if uinput_key is None:
+            recv, send = Pipe(duplex = False)
+            self.key_source = PipeKeys(recv)
+            self._sink = _PipeSink(send)
+        else:
+            if UInput is None:
+                raise ImportError('uinput triggers require python-evdev')
+            self.key_source = None
+            self._sink = _UInputSink(uinput_key)
+
+    def start(self, begin = True, timeout = 10.):
+        '''
+        Starts the emulator process and blocks until its trigger sink (for
+        uinput, the virtual keyboard) exists, so a TR listener can be
+        started on it. Triggers start start_delay seconds after begin(),
+        which is called straight away if begin is True.
+        '''
+        self._stop_event = Event()
+        self._ready_event = Event()
+        self._begin_event = Event()
+        self._times_queue = Queue()
+        self._process = Process(
+            target = emulate,
+            args = (
+                self._stop_event, self._ready_event, self._begin_event,
+                self._sink, self.TR, self.jitter, self.dropout, self.n_TRs,
+                self.start_delay, self.seed, self._times_queue
+                )
+            )
+        self._process.start()
+        deadline = time() + timeout
+        while not self._ready_event.wait(.05):
+            if not self._process.is_alive() or time() > deadline:
+                self._process.terminate()
+                self._process = None
+                raise RuntimeError('The scanner emulator failed to start.')
+        if begin:
+            self.begin()
+
+    def begin(self):
+        '''
+        starts sending triggers, as the scanner operator starting a scan
+        '''
+        if self._process is not None:
+            self._begin_event.set()
+
+    def stop(self):
+        '''
+        Stops sending triggers, and returns (and keeps, as self.times) a
+        dict of the times they were sent and the times of those dropped.
+        '''
+        if self._process is not None:
+            self._stop_event.set()
+            self._begin_event.set()
+        return self.join()
+
+    def join(self):
+        '''
+        Waits for all n_TRs triggers to be due, then returns the same as
+        stop().
+        '''
+        if self._process is None:
+            return self.times
+        sent, dropped = self._times_queue.get() # before join, or it can hang
+        self._process.join()
+        self._process = None
+        self.times = dict(sent = np.array(sent), dropped = np.array(dropped))
+        return self.times